@@ -0,0 +1,160 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Describe the shape of the Drupal content for sizing a migration.
+
+Narrow numeric columns of every node and comment are fetched in batches
+straight into NumPy arrays and aggregated with vectorised operations:
+nodes per year, month, type and author, body length percentiles and
+comments per node.
+
+NumPy is optional. Without it the analyse action skips these statistics.
+"""
+
+import logging
+try:
+    import numpy as np
+except ImportError:
+    # Only needed for content statistics
+    np = None
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = [50, 90, 95, 99]
+TOP_AUTHORS = 10
+
+# Columns of Database.get_node_shape_batches()
+NODE_DTYPE = [
+    ('nid', 'i8'),
+    ('type', 'O'),
+    ('uid', 'i8'),
+    ('created', 'i8'),
+    ('body_length', 'i8'),
+]
+
+
+def available():
+    """Check whether NumPy is installed."""
+    return np is not None
+
+
+def fetch_array(batches, dtype):
+    """Build a structured array from batches of row tuples.
+
+    Args:
+        batches (iterable): Lists of row tuples, e.g. from
+            Database.iter_query() with batches and compact set.
+        dtype (list): (column name, NumPy type) pairs in row order.
+
+    Returns:
+        numpy.ndarray: One record per row.
+    """
+    array = np.zeros(0, dtype=dtype)
+    count = 0
+    for batch in batches:
+        end = count + len(batch)
+        if end > len(array):
+            # Doubling keeps the rows copied while growing linear
+            array.resize(max(end, 2 * len(array)), refcheck=False)
+        array[count:end] = np.array(batch, dtype=dtype)
+        count = end
+    # Give back the unused capacity
+    array.resize(count, refcheck=False)
+    return array
+
+
+def _counts(values, labels=None):
+    """Count each distinct value, as a list of (label, count) pairs."""
+    if not len(values):
+        return []
+    unique, counts = np.unique(values, return_counts=True)
+    if labels is not None:
+        unique = labels(unique)
+    else:
+        unique = unique.tolist()
+    return [(label, int(count)) for label, count in zip(unique, counts)]
+
+
+def _percentiles(values):
+    """Summarise a distribution for the report."""
+    if not len(values):
+        return None
+    summary = dict(
+        ("p{}".format(percentile), float(value))
+        for percentile, value in zip(
+            PERCENTILES,
+            np.percentile(values, PERCENTILES)
+        )
+    )
+    summary['mean'] = float(values.mean())
+    summary['max'] = int(values.max())
+    return summary
+
+
+def summarise(nodes, comment_nids):
+    """Aggregate the node and comment columns.
+
+    Args:
+        nodes (numpy.ndarray): Node records with the NODE_DTYPE columns.
+        comment_nids (numpy.ndarray): The node ID of each comment.
+
+    Returns:
+        dictionary: The statistics, using only JSON friendly types.
+    """
+    created = nodes['created'].astype('datetime64[s]')
+    authors = sorted(
+        _counts(nodes['uid']),
+        key=lambda author: author[1],
+        reverse=True
+    )
+
+    # Comments are only fetched for existing nodes, so the nodes missing
+    # from the counts are the ones without comments
+    comment_counts = np.unique(comment_nids, return_counts=True)[1]
+    per_node = np.concatenate([
+        comment_counts,
+        np.zeros(max(len(nodes) - len(comment_counts), 0), dtype='i8')
+    ])
+
+    return {
+        'nodes': int(len(nodes)),
+        'comments': int(len(comment_nids)),
+        'nodes_per_year': _counts(
+            created.astype('datetime64[Y]'),
+            lambda years: [str(year) for year in years]
+        ),
+        'nodes_per_month': _counts(
+            created.astype('datetime64[M]'),
+            lambda months: [str(month) for month in months]
+        ),
+        'nodes_per_type': _counts(nodes['type']),
+        'authors': len(authors),
+        'nodes_per_author': authors[:TOP_AUTHORS],
+        'body_length': _percentiles(nodes['body_length']),
+        'comments_per_node': _percentiles(per_node),
+    }
+
+
+def get_content_stats(dbconn):
+    """Fetch and aggregate the content statistics of a Drupal database.
+
+    Args:
+        dbconn: An open connection to the Drupal database.
+
+    Returns:
+        dictionary: See summarise().
+    """
+    if np is None:
+        raise ImportError(
+            "Content statistics require NumPy (pip install numpy)"
+        )
+    nodes = fetch_array(dbconn.get_node_shape_batches(), NODE_DTYPE)
+    comment_nids = fetch_array(
+        dbconn.get_comment_node_batches(),
+        [('nid', 'i8')]
+    )['nid']
+    logger.debug(
+        "Fetched %s nodes and %s comments for content statistics",
+        len(nodes),
+        len(comment_nids)
+    )
+    return summarise(nodes, comment_nids)
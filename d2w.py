@@ -4,7 +4,7 @@
 
 This module is a helper utility to migrate a Drupal site to WordPress.
 
-Usage: drupaltowordpress.py [-h --help | -a=analyse|migrate|reset|sqlscript] [-d=database_name] [-s=script_path]
+Usage: drupaltowordpress.py [-h --help | -a=analyse|migrate|recount|reset|restore|sqlscript] [-d=database_name] [-s=script_path] [-w=workers] [-p] [-f=statement] [-r] [--details] [--fast] [--json]
 
 Options:
 -a act, --action act
@@ -16,12 +16,43 @@ Options:
 -s script_path, --sqlscript script_path
     Run a MySQL script file specified by script_path
 
+-w workers, --workers workers
+    Number of tables to load at the same time with the restore action
+
+-p, --profile
+    Time each statement of the migrate or sqlscript scripts, print the
+    slowest and save the profile as JSON in the project directory
+
+-f statement, --from-statement statement
+    Start the migration script, or the sqlscript script, at the given
+    statement number instead of resuming from the last completed one
+
+-r, --restart
+    Run the prepare, migrate and deploy scripts from the beginning even
+    if an earlier run stopped part way through
+
+--details
+    List the terms and aliases behind each problem found by the analyse
+    action instead of only counting them
+
+--fast
+    Estimate the counts of the analyse action from table statistics and
+    a random sample of rows instead of counting every row. Estimates are
+    marked with a ~ and a 95% confidence interval
+
+--json
+    Also save the results of the analyse action as JSON in the project
+    directory
+
 -h, --help
     Display options
 
 Actions:
-analyse     : Analyse the Drupal database
+analyse     : Analyse the Drupal database, including content statistics
+              if NumPy is installed
 migrate     : Run the migration script
+recount     : Recalculate post comment counts and term counts after migrating
+restore     : Restore the specified database dump, loading tables in parallel
 sqlscript   : Run the specified MySQL script file
 """
 
@@ -30,7 +61,12 @@ import logging, logging.handlers
 import yaml
 from datetime import datetime
 import display_cli as cli
-import prepare, migrate, deploy
+import prepare, migrate, deploy, restore
+import diagnostics
+import content_stats
+import estimates
+import session
+import sql_script
 from database_interface import Database
 from MySQLdb import OperationalError
 
@@ -105,25 +141,26 @@ def get_settings():
     return settings
 
 
-def run_diagnostics(settings, database=None):
+def run_diagnostics(settings, database=None, details=False, fast=False):
     """ Show Drupal database analysis but don't alter any Drupal CMS tables.
 
+    Only counts are sent back by the server unless details are requested.
+    The queries run in parallel on up to d2w.diagnostics_workers
+    connections. If NumPy is installed, content statistics are computed
+    from the node and comment columns as well.
+
+    In fast mode the counts are estimated instead and listed under
+    "estimates", and the full table scans are skipped.
+
     Args:
         database: The Drupal database to analyse.
+        details: Also fetch the terms and aliases behind each problem.
+        fast: Estimate the counts from table statistics and samples.
     """
     results = {}
-    
     try:
-        if not database:
-            database = settings['database']['drupal_database']
-
-        dbconn = Database(
-            settings['database']['drupal_host'],
-            settings['database']['drupal_username'],
-            settings['database']['drupal_password'],
-            database
-        )
-    except AttributeError:
+        drupal_session = session.Session(settings, Database, database)
+    except (AttributeError, KeyError, TypeError):
         logging.error("Settings file is missing database information.") 
     except OperationalError:
         logging.error(
@@ -131,60 +168,116 @@ def run_diagnostics(settings, database=None):
             "Aborting database creation."
         )
     else:
-        try:
-            drupal_version = dbconn.get_drupal_version()
-        except OperationalError:
-            drupal_version = None
-            logging.warning(
-                "Could not get Drupal version."
+        with drupal_session:
+            results = get_diagnostics(
+                settings,
+                drupal_session.dbconn,
+                details,
+                fast
             )
-            
-        if drupal_version:
-            logging.debug("Checking tables...")
-            all_tables_present = check_tables(dbconn, float(drupal_version))
-        else:
-            drupal_version = "Unknown"
-            logging.error(
-                "Could not check tables since the Drupal version is unknown.")
+    return results
 
-        try:
-            # General analysis of Drupal database properties
-            drupal_sitename = dbconn.get_drupal_sitename()
-            drupal_posts_count = len(dbconn.get_drupal_posts())
-            drupal_terms_count = len(dbconn.get_drupal_terms())
-            drupal_node_types = dbconn.get_drupal_node_types()
-            drupal_node_types_count = len(drupal_node_types)
-            drupal_node_count_by_type = dbconn.get_drupal_node_count_by_type()
-            logging.debug("Looking for common problems")
+
+def get_diagnostics(settings, dbconn, details=False, fast=False):
+    """Run the analysis queries on an open connection.
+
+    The queries run in parallel on up to d2w.diagnostics_workers
+    connections of the session pool.
+
+    Args:
+        dbconn: An open connection to the Drupal database.
+        details: Also fetch the terms and aliases behind each problem.
+        fast: Estimate the counts from table statistics and samples.
+
+    Returns:
+        dictionary: The diagnostics results, empty if they failed.
+    """
+    results = {}
+    try:
+        drupal_version = dbconn.get_drupal_version()
+    except OperationalError:
+        drupal_version = None
+        logging.warning(
+            "Could not get Drupal version."
+        )
+        
+    if drupal_version:
+        logging.debug("Checking tables...")
+        all_tables_present = check_tables(dbconn, float(drupal_version))
+    else:
+        drupal_version = "Unknown"
+        logging.error(
+            "Could not check tables since the Drupal version is unknown.")
+
+    if fast:
+        sample_size = (settings.get('d2w') or {}).get(
+            'analyse_sample_size',
+            estimates.DEFAULT_SAMPLE_SIZE
+        )
+        queries = [
+            ("estimates",
+             lambda connection: connection.estimate_diagnostics(sample_size)),
+            ("node_types", "get_drupal_node_types"),
+            ("sitename", "get_drupal_sitename"),
+        ]
+    else:
+        # Slowest queries first so they start straight away
+        queries = [
             # Look for common problems
-            duplicate_terms_count = len(dbconn.get_drupal_duplicate_term_names())
-            terms_exceeded_char_count = len(dbconn.get_terms_exceeded_charlength())
-            duplicate_aliases_count = len(dbconn.get_duplicate_aliases())
-        except Exception as ex:
-            logging.error(
-                "Could not run diagnostics. Please use a database interface "
-                "that supports Drupal version %s.",
-                drupal_version
-            )
-        else:
-            results = {
-                "sitename": drupal_sitename,
-                "version": drupal_version,
-                "posts_count": drupal_posts_count,
-                "terms_count": drupal_terms_count,
-                "duplicate_terms_count": duplicate_terms_count,
-                "node_types_count": drupal_node_types_count,
-                "node_types": drupal_node_types,
-                "terms_exceeded_char_count": terms_exceeded_char_count,
-                "duplicate_aliases_count": duplicate_aliases_count,
-                "node_count_by_type": drupal_node_count_by_type
-            }
+            ("duplicate_aliases_count", "count_duplicate_aliases"),
+            ("duplicate_terms_count", "count_drupal_duplicate_term_names"),
+            ("terms_exceeded_char_count", "count_terms_exceeded_charlength"),
+            # General analysis of Drupal database properties
+            ("node_count_by_type", "get_drupal_node_count_by_type"),
+            ("posts_count", "count_drupal_posts"),
+            ("terms_count", "count_drupal_terms"),
+            ("node_types", "get_drupal_node_types"),
+            ("sitename", "get_drupal_sitename"),
+        ]
+    if fast:
+        # Content statistics need every node and comment
+        logging.info("Content statistics are skipped in fast mode")
+    elif content_stats.available():
+        # Scans every node and comment so start it first
+        queries.insert(0, ("content_stats", content_stats.get_content_stats))
+    else:
+        logging.info("Install NumPy to also get content statistics")
+    if details:
+        queries.extend([
+            ("duplicate_aliases", "get_duplicate_aliases"),
+            ("duplicate_terms", "get_drupal_duplicate_term_names"),
+            ("terms_exceeded_char", "get_terms_exceeded_charlength"),
+        ])
+    workers = (settings.get('d2w') or {}).get(
+        'diagnostics_workers',
+        diagnostics.DEFAULT_WORKERS
+    )
+    try:
+        results = diagnostics.run_queries(dbconn, queries, workers)
+    except Exception:
+        results = {}
+        logging.error(
+            "Could not run diagnostics. Please use a database interface "
+            "that supports Drupal version %s.",
+            drupal_version
+        )
+    else:
+        results["version"] = drupal_version
+        results["node_types_count"] = len(results["node_types"])
+        if fast:
+            found = results.pop("estimates")
+            results["estimates"] = {}
+            for key, estimate in found.items():
+                results[key] = estimate.value
+                results["estimates"][key] = estimate.to_dict()
     return results
 
 
 def check_tables(dbconn, drupal_version):
     """Check if the required tables are present.
 
+    The tables of the database are fetched once and checked in memory.
+
     Args:
         dbconn: An open connection to the Drupal database.
 
@@ -228,9 +321,9 @@ def check_tables(dbconn, drupal_version):
         logging.debug("Using D7 tables")
         tables = tables_d7
 
+    schema_tables = dbconn.get_schema_tables()
     for table in tables:
-        count = dbconn.get_table_count(table)
-        if count > 0:
+        if table in schema_tables:
             print "...{} table exists".format(table)
         else:
             print "...{} table does not exist".format(table)
@@ -238,46 +331,204 @@ def check_tables(dbconn, drupal_version):
     return all_tables_present
 
 
-def run_sql_script(settings, filename, database=None):
+def run_sql_script(settings, filename, database=None, profile=False,
+                   from_statement=None):
     """Run a specified mySQL script.
 
     Args:
         dbconn: An open connection to the Drupal database.
-        filename: Filename with full path to the script.
+        filename: Filename with full path to the script. Dumps
+            compressed with gzip (.gz) or xz (.xz) are also accepted.
+        profile: Report the time taken by each statement.
+        from_statement: Start the script at this statement.
     
     Returns:
         True if the file was executed.
     """
     result = False
-    if not database:
-        database = settings['database']['drupal_database']
-    
     try:
-        dbconn = Database(
-            settings['database']['drupal_host'],
-            settings['database']['drupal_username'],
-            settings['database']['drupal_password'],
-            database
-        )
-    except AttributeError:
+        drupal_session = session.Session(settings, Database, database)
+    except (AttributeError, KeyError, TypeError):
         logging.error("Settings file is missing database information.") 
     except OperationalError:
         logging.error(
             "Could not access the database. "
             "Aborting database creation."
         )
-    else:    
-        if os.path.isfile(filename):
-            if dbconn.connected():
-                result = dbconn.execute_sql_file(filename, database)
-            else:
-                logging.error("No database connection")
+    else:
+        with drupal_session:
+            result = _run_sql_script(
+                settings,
+                drupal_session.dbconn,
+                filename,
+                drupal_session.database,
+                profile,
+                from_statement
+            )
+    return result
+
+
+def _run_sql_script(settings, dbconn, filename, database, profile,
+                    from_statement):
+    """Run a script file on an open connection for run_sql_script()."""
+    result = False
+    if os.path.isfile(filename):
+        if dbconn.connected():
+            if profile:
+                dbconn.start_profiling()
+            d2w_settings = settings.get('d2w') or {}
+            result = dbconn.execute_sql_file(
+                filename,
+                database,
+                d2w_settings.get(
+                    'sql_chunk_size',
+                    sql_script.DEFAULT_CHUNK_SIZE
+                ),
+                d2w_settings.get('sql_use_mmap', False),
+                from_statement=from_statement
+            )
+            if profile:
+                report_profile(settings, dbconn.get_profile())
         else:
-            logging.error("No script file found at: %s", filename)
+            logging.error("No database connection")
+    else:
+        logging.error("No script file found at: %s", filename)
+    return result
+
+
+def run_recount(settings, database=None):
+    """Recalculate the comment and term counts of the migrated content.
+
+    Args:
+        database: The database holding the migrated tables.
+
+    Returns:
+        True if the counts were recalculated.
+    """
+    result = False
+    try:
+        drupal_session = session.Session(settings, Database, database)
+    except (AttributeError, KeyError, TypeError):
+        logging.error("Settings file is missing database information.")
+    except OperationalError:
+        logging.error(
+            "Could not access the database. "
+            "Aborting recount."
+        )
+    else:
+        with drupal_session:
+            result = migrate.recount(
+                drupal_session.dbconn,
+                migrate.get_recount_chunk_size(settings)
+            )
+    return result
+
+
+def run_restore(settings, filename, database=None, workers=None):
+    """Restore a database dump, loading its tables in parallel.
+
+    Args:
+        filename: Filename with full path to the mysqldump file.
+        database: The database to restore into.
+        workers: Number of tables to load at the same time.
+
+    Returns:
+        True if the dump was restored.
+    """
+    result = False
+    if os.path.isfile(filename):
+        try:
+            result = restore.restore_dump(settings, filename, database, workers)
+        except (AttributeError, KeyError):
+            logging.error("Settings file is missing database information.")
+        except ValueError as ex:
+            logging.error("%s", ex)
+    else:
+        logging.error("No dump file found at: %s", filename)
     return result
 
 
-def process_migration(settings, database=None):
+def get_output_filename(settings, prefix):
+    """Get a timestamped JSON file name for a report.
+
+    The file goes in the project directory, or next to the log file if
+    no project directory is set.
+
+    Args:
+        prefix (string): The start of the file name, e.g. "profile".
+
+    Returns:
+        string: The path of the JSON file.
+    """
+    try:
+        project_path = settings['project']['default_project_path']
+    except (KeyError, TypeError):
+        project_path = None
+    if not project_path:
+        project_path = os.path.dirname(os.path.realpath(__file__))
+    return os.path.join(
+        project_path,
+        "{}_{}.json".format(prefix, datetime.now().strftime("%Y%m%d%H%M%S"))
+    )
+
+
+def save_diagnostics(settings, results):
+    """Save the results of the analyse action as JSON.
+
+    Args:
+        results (dictionary): The diagnostics results.
+
+    Returns:
+        string: The path of the JSON file.
+    """
+    results_filename = get_output_filename(settings, "analysis")
+    try:
+        diagnostics.write_json(results, results_filename)
+    except IOError:
+        logger.error("Could not write analysis to %s", results_filename)
+    else:
+        logger.info("Saved analysis to %s", results_filename)
+    return results_filename
+
+
+def report_profile(settings, profile):
+    """Print the slowest statements and save the profile as JSON.
+
+    The JSON file is written to the project directory, or next to the
+    log file if no project directory is set.
+
+    Args:
+        profile (ScriptProfile): The statement timings to report.
+
+    Returns:
+        string: The path of the JSON file.
+    """
+    profile_filename = get_output_filename(settings, "profile")
+
+    cli.print_header("Slowest statements")
+    cli.print_profile(profile)
+    try:
+        profile.write_json(profile_filename)
+    except IOError:
+        logger.error("Could not write profile to %s", profile_filename)
+    else:
+        logger.info("Saved statement profile to %s", profile_filename)
+    return profile_filename
+
+
+def process_migration(settings, database=None, profile=False, restart=False,
+                      from_statement=None):
+    """Prepare, migrate and deploy the database.
+
+    If an earlier run failed, each script resumes from the first
+    statement that didn't complete.
+
+    Args:
+        database: The database to migrate.
+        profile: Report the time taken by each statement.
+        restart: Run every script from the beginning.
+        from_statement: Start the migration script at this statement.
+    """
     # Continue unless something happens to abort process
     continue_script = True
     print "The migration process will alter your database"
@@ -285,29 +536,64 @@ def process_migration(settings, database=None):
         
     if continue_script:
         try:
-            if not database:
-                database = settings['database']['drupal_database']
-
-            dbconn = Database(
-                settings['database']['drupal_host'],
-                settings['database']['drupal_username'],
-                settings['database']['drupal_password'],
-                database
-            )
-        except AttributeError:
+            drupal_session = session.Session(settings, Database, database)
+        except (AttributeError, KeyError, TypeError):
             logger.error("Settings file is missing database information.") 
+            continue_script = False
         except OperationalError:
             logger.error(
                 "Could not access the database. Aborting database creation."
             )
+            continue_script = False
         else:
-            cli.print_header("Preparing {} for migration".format(database))
-            continue_script = prepare.prepare_migration(settings, dbconn, database)
-            
+            with drupal_session:
+                continue_script = migrate_with_session(
+                    settings,
+                    drupal_session.dbconn,
+                    drupal_session.database,
+                    profile,
+                    restart,
+                    from_statement
+                )
+
+    if not continue_script:
+        sys.exit(1)
+
+
+def migrate_with_session(settings, dbconn, database, profile=False,
+                         restart=False, from_statement=None):
+    """Prepare, migrate and deploy the database on one connection.
+
+    Args:
+        dbconn: The primary connection of the session.
+        database: The database to migrate.
+        profile: Report the time taken by each statement.
+        restart: Run every script from the beginning.
+        from_statement: Start the migration script at this statement.
+
+    Returns:
+        True if every step succeeded.
+    """
+    if profile:
+        dbconn.start_profiling()
+    cli.print_header("Preparing {} for migration".format(database))
+    continue_script = prepare.prepare_migration(
+        settings,
+        dbconn,
+        database,
+        restart
+    )
+
     if continue_script:
-        if check_migration_prerequisites(settings, dbconn, database):
+        if check_migration_prerequisites(settings, dbconn):
             cli.print_header("Migrating content from {}".format(database))
-            continue_script = migrate.run_migration(settings, dbconn, database)
+            continue_script = migrate.run_migration(
+                settings,
+                dbconn,
+                database,
+                restart,
+                from_statement
+            )
         else:
             logging.critical(
                 "Migration aborted because it did not meet "
@@ -316,18 +602,27 @@ def process_migration(settings, database=None):
 
     if continue_script:
         cli.print_header("Deploying to test environment")
-        continue_script = deploy.deploy_database(settings, dbconn, database)
+        continue_script = deploy.deploy_database(
+            settings,
+            dbconn,
+            database,
+            restart
+        )
 
-    if not continue_script:
-        sys.exit(1)
+    if profile and dbconn.get_profile():
+        report_profile(settings, dbconn.get_profile())
+    return continue_script
 
 
-def check_migration_prerequisites(settings, dbconn, database=None):
-    """Run the migration script.
+def check_migration_prerequisites(settings, dbconn):
+    """Check that the problems fixed by prepare are gone.
+
+    Only the exact problem counts are queried, on the given connection
+    and its session pool.
 
     Args:
         dbconn: An open connection to the Drupal database.
-        
+
     Returns:
         True if OK to proceed; False if migration should be aborted.
     """
@@ -336,7 +631,15 @@ def check_migration_prerequisites(settings, dbconn, database=None):
     custom_script_exists = False
     success = False
     if dbconn.connected():
-        diagnostic_results = run_diagnostics(settings, database)
+        workers = (settings.get('d2w') or {}).get(
+            'diagnostics_workers',
+            diagnostics.DEFAULT_WORKERS
+        )
+        diagnostic_results = diagnostics.run_queries(dbconn, [
+            ("duplicate_aliases_count", "count_duplicate_aliases"),
+            ("duplicate_terms_count", "count_drupal_duplicate_term_names"),
+            ("terms_exceeded_char_count", "count_terms_exceeded_charlength"),
+        ], workers)
         duplicate_terms_count = diagnostic_results["duplicate_terms_count"]
         terms_exceeded_char_count = diagnostic_results["terms_exceeded_char_count"]
         duplicate_aliases_count = diagnostic_results["duplicate_aliases_count"]
@@ -376,15 +679,49 @@ def process_action(settings, action, options):
     # Process command line options and arguments
     if action in ['analyse', 'analyze']:
         cli.print_header("Starting Drupal To WordPress diagnostics")
-        diagnostics_results = run_diagnostics(settings, selected_database)
+        diagnostics_results = run_diagnostics(
+            settings,
+            selected_database,
+            options.get('details_option', False),
+            options.get('fast_option', False)
+        )
         if diagnostics_results:
             cli.print_diagnostics(diagnostics_results)
+            if options.get('json_option', False):
+                save_diagnostics(settings, diagnostics_results)
     elif action == 'migrate':
-        process_migration(settings, selected_database)
+        process_migration(
+            settings,
+            selected_database,
+            options.get('profile_option', False),
+            options.get('restart_option', False),
+            options.get('from_statement_option')
+        )
+    elif action == 'recount':
+        cli.print_header("Recounting comments and terms")
+        run_recount(settings, selected_database)
+    elif action == 'restore':
+        # Has the user specified a dump file?
+        if 'script_option' in options:
+            run_restore(
+                settings,
+                options['script_option'],
+                selected_database,
+                options.get('workers_option')
+            )
+        else:
+            print "You need to provide a path to the dump file."
+            cli.print_usage()
     elif action == 'sqlscript':
         # Has the user specified a sql script?
         if 'script_option' in options:
-            run_sql_script(settings, options['script_option'], selected_database)
+            run_sql_script(
+                settings,
+                options['script_option'],
+                selected_database,
+                options.get('profile_option', False),
+                options.get('from_statement_option')
+            )
         else:
             print "You need to provide a path to the script."
             cli.print_usage()
@@ -405,8 +742,11 @@ def main(argv):
     try:
         opts, args = getopt.getopt(
             argv,
-            "a:d:s:h",
-            ["action=", "database=", "script=", "help"]
+            "a:d:s:w:pf:rh",
+            [
+                "action=", "database=", "script=", "workers=", "profile",
+                "from-statement=", "restart", "details", "fast", "json", "help"
+            ]
         )
     except getopt.GetoptError:
         cli.print_usage()
@@ -426,6 +766,28 @@ def main(argv):
                 options['db_option'] = arg
             elif opt in ("-s", "--sqlscript"):
                 options['script_option'] = arg
+            elif opt in ("-w", "--workers"):
+                try:
+                    options['workers_option'] = int(arg)
+                except ValueError:
+                    cli.print_usage()
+                    sys.exit(2)
+            elif opt in ("-p", "--profile"):
+                options['profile_option'] = True
+            elif opt in ("-f", "--from-statement"):
+                try:
+                    options['from_statement_option'] = int(arg)
+                except ValueError:
+                    cli.print_usage()
+                    sys.exit(2)
+            elif opt in ("-r", "--restart"):
+                options['restart_option'] = True
+            elif opt == "--details":
+                options['details_option'] = True
+            elif opt == "--fast":
+                options['fast_option'] = True
+            elif opt == "--json":
+                options['json_option'] = True
             elif opt in ("-a", "--action"):
                 action = arg
     # Only process actions after getting all the specified options
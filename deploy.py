@@ -8,11 +8,13 @@ to the staging server
 
 import os, subprocess
 
-def deploy_database(settings, dbconn, database=None):
+def deploy_database(settings, dbconn, database=None, restart=False):
     """Deploy the database
 
     Args:
         database: An open connection to the Drupal database.
+        restart: Run the whole deploy script even if an earlier run
+            stopped part way through.
     
     Deploy the database tables into the staging server.
     """
@@ -24,7 +26,13 @@ def deploy_database(settings, dbconn, database=None):
         print "Could not find custom deploy script."
     else:
         if os.path.isfile(custom_sql):
-            deployed = dbconn.execute_sql_file(custom_sql, database)
+            deployed = dbconn.execute_sql_file(
+                custom_sql,
+                database,
+                checkpoint=True,
+                restart=restart,
+                bulk_load=(settings.get('d2w') or {}).get('bulk_load', False)
+            )
         else:
             print "No custom deploy SQL found at {}".format(custom_sql)
         #################################
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Run the analysis queries of the analyse action in parallel.
+
+Each query is a Database method that takes no arguments, or a function
+that takes the connection. The queries are shared out among a few
+connections, one per thread, so the analysis takes about as long as its
+slowest query rather than the sum of them.
+"""
+
+import json
+import time
+import logging
+import threading
+import Queue
+from datetime import date, datetime
+from decimal import Decimal
+from MySQLdb import OperationalError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+
+
+def _run_queries(dbconn, tasks, results):
+    """Run the queries from the task queue until it is empty."""
+    while True:
+        try:
+            key, method = tasks.get_nowait()
+        except Queue.Empty:
+            break
+        start = time.time()
+        try:
+            if callable(method):
+                value = method(dbconn)
+            else:
+                value = getattr(dbconn, method)()
+        except Exception as ex:
+            # Report any failure so every key gets an answer
+            results.put((key, None, ex))
+        else:
+            logger.debug("%s took %.2fs", key, time.time() - start)
+            results.put((key, value, None))
+
+
+def run_queries(dbconn, queries, workers=DEFAULT_WORKERS):
+    """Call Database methods concurrently, one connection per thread.
+
+    Args:
+        dbconn (Database): An open connection, used as one of the workers.
+        queries (list): (key, method name) tuples. A function that
+            takes the connection can be given instead of a method name.
+            List the slowest queries first so they start straight away.
+        workers (integer): Maximum number of connections to use.
+
+    Returns:
+        dictionary: The result of each method, keyed by its key.
+
+    Raises:
+        The first exception raised by a method, after all have finished.
+    """
+    tasks = Queue.Queue()
+    for query in queries:
+        tasks.put(query)
+    results = Queue.Queue()
+
+    connections = [dbconn]
+    try:
+        while len(connections) < min(int(workers), len(queries)):
+            try:
+                connections.append(dbconn.clone())
+            except OperationalError:
+                logger.warning(
+                    "Could only open %s connections for diagnostics",
+                    len(connections)
+                )
+                break
+        if len(connections) == 1:
+            _run_queries(dbconn, tasks, results)
+        else:
+            threads = []
+            for connection in connections:
+                thread = threading.Thread(
+                    target=_run_queries,
+                    args=(connection, tasks, results)
+                )
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+    finally:
+        for connection in connections[1:]:
+            connection.close()
+
+    found = {}
+    error = None
+    while not results.empty():
+        key, value, ex = results.get()
+        if ex is not None and error is None:
+            error = ex
+        found[key] = value
+    if error is not None:
+        raise error
+    return found
+
+
+def _jsonable(value):
+    """Convert query results to types the json module can write."""
+    if hasattr(value, '_asdict'):
+        value = value._asdict()
+    if isinstance(value, dict):
+        return dict((key, _jsonable(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(item) for item in value]
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def write_json(results, filename):
+    """Write the analysis results to a JSON file.
+
+    Args:
+        results (dictionary): The results of the analyse action.
+        filename (string): The file to write.
+    """
+    with open(filename, 'w') as results_file:
+        json.dump(_jsonable(results), results_file, indent=2, sort_keys=True)
@@ -5,7 +5,7 @@
 This module handles display of pyD2W results to the command line.
 """
 
-import sys
+import sys, os
 from prettytable import PrettyTable
 import getpass
 
@@ -21,6 +21,28 @@ def print_header(header_text):
     print "=================================================="
 
 
+def format_count(diagnostic_results, key):
+    """Format a diagnostics count, marking estimates.
+
+    Args:
+        diagnostic_results (dictionary): A dictionary containing the results.
+        key (string): The key of the count.
+
+    Returns:
+        string: The count, or "~count (...)" if it was estimated.
+    """
+    estimate = diagnostic_results.get("estimates", {}).get(key)
+    if not estimate or estimate["method"] == "exact":
+        return str(diagnostic_results[key])
+    if estimate["method"] == "statistics":
+        return "~{} (table statistics)".format(estimate["value"])
+    return "~{} (95% CI {}-{})".format(
+        estimate["value"],
+        estimate["low"],
+        estimate["high"]
+    )
+
+
 def print_diagnostics(diagnostic_results):
     """Print the diagnostic results to the command line.
 
@@ -30,13 +52,14 @@ def print_diagnostics(diagnostic_results):
 
     sitename = diagnostic_results["sitename"]    
     version = diagnostic_results["version"]
-    posts_count = diagnostic_results["posts_count"]
-    terms_count = diagnostic_results["terms_count"]
-    duplicate_terms_count = diagnostic_results["duplicate_terms_count"]
+    posts_count = format_count(diagnostic_results, "posts_count")
+    terms_count = format_count(diagnostic_results, "terms_count")
+    duplicate_terms_count = format_count(diagnostic_results, "duplicate_terms_count")
     node_types_count = diagnostic_results["node_types_count"]
-    terms_exceeded_char_count = diagnostic_results["terms_exceeded_char_count"]
-    duplicate_aliases_count = diagnostic_results["duplicate_aliases_count"]
-    node_count_by_type = diagnostic_results["node_count_by_type"]
+    terms_exceeded_char_count = format_count(diagnostic_results, "terms_exceeded_char_count")
+    duplicate_aliases_count = format_count(diagnostic_results, "duplicate_aliases_count")
+    # Not estimated in fast mode
+    node_count_by_type = diagnostic_results.get("node_count_by_type")
     node_types = diagnostic_results["node_types"]
 
     print "{} runs Drupal version: {}".format(sitename, version)
@@ -57,7 +80,19 @@ def print_diagnostics(diagnostic_results):
     table_properties.add_row([
         "Duplicate aliases",
         "{} duplicate aliases found".format(duplicate_aliases_count)])
+    if "surplus_aliases" in diagnostic_results:
+        table_properties.add_row([
+            "Surplus aliases",
+            "{} aliases share a path with another".format(
+                format_count(diagnostic_results, "surplus_aliases"))])
+    if "surplus_terms" in diagnostic_results:
+        table_properties.add_row([
+            "Surplus terms",
+            "{} terms share a name with another".format(
+                format_count(diagnostic_results, "surplus_terms"))])
     print table_properties
+    if diagnostic_results.get("estimates"):
+        print "Counts marked ~ are estimates. Run without --fast for exact counts."
 
     table_node_types = PrettyTable(["Node type"])
     table_node_types.align["Node type"] = "l"
@@ -66,13 +101,114 @@ def print_diagnostics(diagnostic_results):
     print table_node_types
 
     # Print Node count by content type table
-    table_node_count_by_type = PrettyTable(["Node type", "Name", "Count"])
-    table_node_count_by_type.align["Node type"] = "l"
-    table_node_count_by_type.align["Name"] = "l"
-    table_node_count_by_type.align["Count"] = "l"
-    for row in node_count_by_type:
-        table_node_count_by_type.add_row([row["type"], row["name"], row["node_count"]])
-    print table_node_count_by_type
+    if node_count_by_type is not None:
+        table_node_count_by_type = PrettyTable(["Node type", "Name", "Count"])
+        table_node_count_by_type.align["Node type"] = "l"
+        table_node_count_by_type.align["Name"] = "l"
+        table_node_count_by_type.align["Count"] = "l"
+        for row in node_count_by_type:
+            table_node_count_by_type.add_row([row["type"], row["name"], row["node_count"]])
+        print table_node_count_by_type
+
+    # Problem details are only present if they were requested
+    if "duplicate_terms" in diagnostic_results:
+        table_duplicate_terms = PrettyTable(["Term ID", "Duplicate term name", "Count"])
+        table_duplicate_terms.align["Duplicate term name"] = "l"
+        for row in diagnostic_results["duplicate_terms"]:
+            table_duplicate_terms.add_row([row["tid"], row["name"], row["c"]])
+        print table_duplicate_terms
+
+    if "terms_exceeded_char" in diagnostic_results:
+        table_long_terms = PrettyTable(["Term ID", "Term name exceeding 200 characters"])
+        table_long_terms.align["Term name exceeding 200 characters"] = "l"
+        for row in diagnostic_results["terms_exceeded_char"]:
+            table_long_terms.add_row([row["tid"], row["name"]])
+        print table_long_terms
+
+    if "duplicate_aliases" in diagnostic_results:
+        table_duplicate_aliases = PrettyTable(["Alias ID", "Path with duplicate aliases", "Count"])
+        table_duplicate_aliases.align["Path with duplicate aliases"] = "l"
+        for row in diagnostic_results["duplicate_aliases"]:
+            # Drupal 7 renamed the src column to source
+            table_duplicate_aliases.add_row([
+                row["pid"],
+                row.get("src", row.get("source")),
+                row["c"]
+            ])
+        print table_duplicate_aliases
+
+    if diagnostic_results.get("content_stats"):
+        print_content_stats(diagnostic_results["content_stats"])
+
+
+def print_content_stats(stats):
+    """Print the shape of the Drupal content.
+
+    Args:
+        stats (dictionary): The results of content_stats.summarise().
+    """
+    print "\nContent statistics: {} nodes, {} comments, {} authors".format(
+        stats["nodes"],
+        stats["comments"],
+        stats["authors"]
+    )
+    for title, key, label in [
+            ("Year", "nodes_per_year", "Nodes"),
+            ("Month", "nodes_per_month", "Nodes"),
+            ("Node type", "nodes_per_type", "Nodes"),
+            ("Author ID", "nodes_per_author", "Nodes (top authors)")]:
+        table_counts = PrettyTable([title, label])
+        table_counts.align[title] = "l"
+        table_counts.align[label] = "r"
+        for value, count in stats[key]:
+            table_counts.add_row([value, count])
+        print table_counts
+
+    table_distributions = PrettyTable([
+        "Distribution", "Median", "90%", "95%", "99%", "Mean", "Max"
+    ])
+    table_distributions.align["Distribution"] = "l"
+    for title, key in [
+            ("Body length (bytes)", "body_length"),
+            ("Comments per node", "comments_per_node")]:
+        summary = stats[key]
+        if summary:
+            table_distributions.add_row([title] + [
+                "{:.0f}".format(summary[column])
+                for column in ("p50", "p90", "p95", "p99", "mean", "max")
+            ])
+    print table_distributions
+
+
+def print_profile(profile, limit=10):
+    """Print the slowest statements of the scripts that were run.
+
+    Args:
+        profile (ScriptProfile): The statement timings to report.
+        limit (integer): The number of statements to show.
+    """
+    total = profile.elapsed
+    print "Ran {} scripts in {:.2f}s".format(len(profile.scripts), total)
+
+    table_profile = PrettyTable([
+        "Rank", "Script", "Lines", "Time (s)", "% of total",
+        "Rows", "Warnings", "Statement"
+    ])
+    table_profile.align["Script"] = "l"
+    table_profile.align["Statement"] = "l"
+    for rank, (script, result) in enumerate(profile.slowest(limit), 1):
+        share = 100.0 * result.elapsed / total if total else 0.0
+        table_profile.add_row([
+            rank,
+            os.path.basename(script.filename),
+            "{}-{}".format(result.first_line, result.last_line),
+            "{:.2f}".format(result.elapsed),
+            "{:.1f}".format(share),
+            result.rowcount,
+            result.warnings,
+            result.summary()
+        ])
+    print table_profile
 
 
 def print_usage():
@@ -81,7 +217,7 @@ def print_usage():
     For the usage format, see http://en.wikipedia.org/wiki/Usage_message.
     """
     print """\
-Usage: drupaltowordpress.py [-h --help | -a=analyse|migrate|reset|sqlscript] [-d=database_name] [-s=script_path]
+Usage: drupaltowordpress.py [-h --help | -a=analyse|migrate|recount|reset|restore|sqlscript] [-d=database_name] [-s=script_path] [-w=workers] [-p] [-f=statement] [-r] [--details] [--fast] [--json]
 
 Options:
 -a act, --action act
@@ -93,12 +229,43 @@ Options:
 -s script_path, --sqlscript script_path
     Run a MySQL script file specified by script_path
 
+-w workers, --workers workers
+    Number of tables to load at the same time with the restore action
+
+-p, --profile
+    Time each statement of the migrate or sqlscript scripts, print the
+    slowest and save the profile as JSON in the project directory
+
+-f statement, --from-statement statement
+    Start the migration script, or the sqlscript script, at the given
+    statement number instead of resuming from the last completed one
+
+-r, --restart
+    Run the prepare, migrate and deploy scripts from the beginning even
+    if an earlier run stopped part way through
+
+--details
+    List the terms and aliases behind each problem found by the analyse
+    action instead of only counting them
+
+--fast
+    Estimate the counts of the analyse action from table statistics and
+    a random sample of rows instead of counting every row. Estimates are
+    marked with a ~ and a 95% confidence interval
+
+--json
+    Also save the results of the analyse action as JSON in the project
+    directory
+
 -h, --help
     Display options
 
 Actions:
-analyse     : Analyse the Drupal database
+analyse     : Analyse the Drupal database, including content statistics
+              if NumPy is installed
 migrate     : Run the migration script
+recount     : Recalculate post comment counts and term counts after migrating
+restore     : Restore the specified database dump, loading tables in parallel
 sqlscript   : Run the specified MySQL script file
 
 """
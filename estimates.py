@@ -0,0 +1,263 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Estimate the analyse results without scanning the big tables.
+
+Totals come from the row estimates in information_schema.TABLES and the
+cardinality of indexes. Problem counts are estimated from a random
+sample of rows, picked by probing random primary keys, with a 95%
+confidence interval. Small tables are counted exactly instead.
+
+Estimates are only for a quick look at a large database. The checks
+made before a migration always use the exact queries.
+"""
+
+import math
+import random
+import logging
+import term_names
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_SIZE = 2000
+# Two-sided 95% confidence
+Z_95 = 1.96
+# Keys looked up per query when sampling
+_LOOKUP_BATCH = 500
+
+
+class Estimate(object):
+    """An estimated count with its 95% confidence interval.
+
+    Attributes:
+        value (long): The estimate.
+        low (long): Lower bound of the interval.
+        high (long): Upper bound of the interval.
+        method (string): "exact", "sample" or "statistics".
+    """
+
+    def __init__(self, value, low=None, high=None, method="sample"):
+        self.value = int(round(value))
+        self.low = self.value if low is None else int(math.floor(low))
+        self.high = self.value if high is None else int(math.ceil(high))
+        self.method = method
+
+    def to_dict(self):
+        return {
+            'value': self.value,
+            'low': self.low,
+            'high': self.high,
+            'method': self.method,
+        }
+
+
+def estimate_total(values, population, complete=False):
+    """Scale a sample mean up to the population.
+
+    Args:
+        values (list): One number between 0 and 1 per sampled row, e.g.
+            1 if the row has a problem and 0 otherwise.
+        population (long): The estimated number of rows in the table.
+        complete (boolean): The values cover every row, so their sum
+            is exact.
+
+    Returns:
+        Estimate: population times the sample mean, with a normal
+            confidence interval corrected for the finite population.
+    """
+    count = len(values)
+    if complete:
+        return Estimate(sum(values), method="exact")
+    if not count:
+        return Estimate(0, 0, population)
+    population = max(population, count)
+    mean = float(sum(values)) / count
+    if not mean:
+        # No hits: use the rule of three for the upper bound
+        return Estimate(0, 0, population * 3.0 / count)
+    variance = sum((value - mean) ** 2 for value in values) / max(count - 1, 1)
+    correction = math.sqrt(float(population - count) / max(population - 1, 1))
+    margin = Z_95 * math.sqrt(variance / count) * correction
+    return Estimate(
+        population * mean,
+        population * max(mean - margin, 0),
+        population * min(mean + margin, 1)
+    )
+
+
+def table_rows(dbconn, table):
+    """Get the estimated row count of a table from information_schema."""
+    return dbconn.get_schema_tables().get(table, {}).get('rows', 0)
+
+
+def index_cardinality(dbconn, table, column):
+    """Get the estimated number of distinct values of an indexed column.
+
+    Args:
+        dbconn: An open connection to the database.
+        table (string): The table name.
+        column (string): A column that leads one of the table's indexes.
+
+    Returns:
+        long: The largest cardinality of the indexes led by column, or
+            None if there is no such index.
+    """
+    return dbconn.query_count(
+        "SELECT MAX(cardinality) FROM information_schema.statistics "
+        "WHERE table_schema = DATABASE() AND table_name = %s "
+        "AND column_name = %s AND seq_in_index = 1",
+        (table, column)
+    ) or None
+
+
+def sample_rows(dbconn, table, key, columns, size=DEFAULT_SAMPLE_SIZE):
+    """Get a uniform random sample of rows by probing random keys.
+
+    Args:
+        dbconn: An open connection to the database.
+        table (string): The table to sample.
+        key (string): Its integer primary key.
+        columns (list): Column expressions to fetch for each row.
+        size (integer): Number of rows wanted.
+
+    Returns:
+        tuple: A list of compact rows with the key followed by the
+            columns, and True if it holds every row of the table, which
+            happens when the table has no more than size rows.
+    """
+    select = "SELECT {}, {} FROM {}".format(key, ", ".join(columns), table)
+    bounds = dbconn.query(
+        "SELECT MIN({0}) low, MAX({0}) high FROM {1}".format(key, table)
+    )
+    low, high = bounds[0]['low'], bounds[0]['high']
+    if low is None:
+        return [], True
+    span = high - low + 1
+    population = max(table_rows(dbconn, table), 1)
+    if span <= size or population <= size:
+        return dbconn.query(select, compact=True), True
+
+    # Draw enough keys to hit about size rows despite gaps in the keys
+    draws = min(span, int(size * 1.25 * span / population) + 1)
+    keys = random.sample(xrange(low, high + 1), draws)
+    found = []
+    for start in range(0, len(keys), _LOOKUP_BATCH):
+        batch = keys[start:start + _LOOKUP_BATCH]
+        found.extend(dbconn.query(
+            "{} WHERE {} IN ({})".format(
+                select,
+                key,
+                ", ".join(["%s"] * len(batch))
+            ),
+            tuple(batch),
+            compact=True
+        ))
+    if len(found) > size:
+        found = random.sample(found, size)
+    return found, False
+
+
+def count_matches(dbconn, table, column, values):
+    """Count the rows of a table sharing each value, by collation.
+
+    Args:
+        dbconn: An open connection to the database.
+        table (string): The table to look in.
+        column (string): The column to match.
+        values (list): The values to count.
+
+    Returns:
+        dictionary: The count for each value's collation key.
+    """
+    counts = {}
+    values = list(set(values))
+    for start in range(0, len(values), _LOOKUP_BATCH):
+        batch = values[start:start + _LOOKUP_BATCH]
+        for row in dbconn.query(
+                "SELECT {0} value, COUNT(*) c FROM {1} "
+                "WHERE {0} IN ({2}) GROUP BY {0}".format(
+                    column,
+                    table,
+                    ", ".join(["%s"] * len(batch))
+                ),
+                tuple(batch),
+                compact=True):
+            key = term_names.collation_key(row['value'])
+            counts[key] = counts.get(key, 0) + row['c']
+    return counts
+
+
+def _shared_share(values, counts):
+    """Weight each sampled value by 1/m if m rows share it, else 0.
+
+    Summed over the whole table this counts each shared value once.
+    """
+    shares = []
+    for value in values:
+        matches = counts.get(term_names.collation_key(value), 1)
+        shares.append(1.0 / matches if matches > 1 else 0.0)
+    return shares
+
+
+def estimate_diagnostics(dbconn, term_table, alias_table, alias_source,
+                         sample_size=DEFAULT_SAMPLE_SIZE):
+    """Estimate the counts reported by the analyse action.
+
+    Args:
+        dbconn: An open connection to the Drupal database.
+        term_table (string): The taxonomy term table.
+        alias_table (string): The URL alias table.
+        alias_source (string): The alias column holding the system path.
+        sample_size (integer): Rows sampled from each table.
+
+    Returns:
+        dictionary: An Estimate for posts_count, terms_count,
+            duplicate_terms_count, terms_exceeded_char_count and
+            duplicate_aliases_count, plus surplus_aliases and
+            surplus_terms when an index gives the distinct values.
+    """
+    estimates = {}
+    terms = table_rows(dbconn, term_table)
+    aliases = table_rows(dbconn, alias_table)
+    estimates['posts_count'] = Estimate(
+        table_rows(dbconn, 'node'), method="statistics"
+    )
+    estimates['terms_count'] = Estimate(terms, method="statistics")
+
+    sample, complete = sample_rows(
+        dbconn, term_table, 'tid',
+        ['name', 'CHAR_LENGTH(name) > 200 too_long'],
+        sample_size
+    )
+    estimates['terms_exceeded_char_count'] = estimate_total(
+        [int(row['too_long']) for row in sample],
+        terms,
+        complete
+    )
+    names = [row['name'] for row in sample]
+    estimates['duplicate_terms_count'] = estimate_total(
+        _shared_share(names, count_matches(dbconn, term_table, 'name', names)),
+        terms,
+        complete
+    )
+
+    sample, complete = sample_rows(
+        dbconn, alias_table, 'pid', [alias_source], sample_size
+    )
+    sources = [row[alias_source] for row in sample]
+    estimates['duplicate_aliases_count'] = estimate_total(
+        _shared_share(
+            sources,
+            count_matches(dbconn, alias_table, alias_source, sources)
+        ),
+        aliases,
+        complete
+    )
+
+    # Rows beyond the first for each distinct value
+    for key, table, column, rows in [
+            ('surplus_aliases', alias_table, alias_source, aliases),
+            ('surplus_terms', term_table, 'name', terms)]:
+        distinct = index_cardinality(dbconn, table, column)
+        if distinct is not None:
+            estimates[key] = Estimate(max(rows - distinct, 0), method="statistics")
+    return estimates
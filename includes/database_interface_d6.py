@@ -8,13 +8,19 @@ Supports Drupal 6 only.
 """
 import MySQLdb as mdb
 import logging
-import os, subprocess
+import sql_script
+import bulk_writer
+import prepared
+import rows as row_types
+import estimates
+import stages
 from phpserialize import unserialize
 #import subprocess
 # Ensures cursors are closed upon completion of with block
 # See discussion at
 # http://stackoverflow.com/questions/5669878/python-mysqldb-when-to-close-cursors
-from contextlib import closing
+from contextlib import closing, contextmanager
+from itertools import islice
 """
 ***** Raising exceptions on warnings *****
 * Migration stages often rely on a the successful completion of a 
@@ -29,6 +35,13 @@ from warnings import filterwarnings
 filterwarnings('error', category = mdb.Warning)
 
 
+# Rows fetched per round trip by Database.iter_query()
+ITER_BATCH_SIZE = 1000
+
+# Savepoint set before each batch written by Database.execute_many()
+BATCH_SAVEPOINT = "d2w_batch"
+
+
 class Database:
     """Class to handle interaction with the Drupal database
 
@@ -42,6 +55,10 @@ class Database:
     _user = ""
     _password = ""
     _database = ""
+    _profile = None
+    _schema_tables = None
+    _statements = None
+    _pool = None
 
 
     def __init__(self, host, user, password, database=None):
@@ -63,7 +80,8 @@ class Database:
                     password,
                     database,
                     charset='utf8',
-                    use_unicode=True
+                    use_unicode=True,
+                    local_infile=1
                 )
             else:
                 self._db_connection = mdb.connect(
@@ -71,7 +89,8 @@ class Database:
                     user,
                     password,
                     charset='utf8',
-                    use_unicode=True
+                    use_unicode=True,
+                    local_infile=1
                 )
         except mdb.OperationalError, ex:
             self._logger.error(
@@ -88,9 +107,87 @@ class Database:
             raise ex
 
 
-    def close(self):
+    def clone(self):
+        """Open another Database with the same credentials and database.
+
+        Use a clone to run queries from another thread. The caller is
+        responsible for closing it. A connection that belongs to a
+        session pool takes the clone from the pool, and raises
+        PoolExhausted, an OperationalError, if none is free.
+        """
+        if self._pool is not None:
+            return self._pool.acquire(block=False)
+        return Database(
+            self._host,
+            self._user,
+            self._password,
+            self._database or None
+        )
+
+
+    def close(self, reuse=True):
+        """Close the connection, or hand it back to its session pool.
+
+        Args:
+            reuse (boolean): False closes a pooled connection for good,
+                e.g. because its session state was changed.
+        """
+        if self._pool is not None:
+            # Pooled connections are handed back rather than closed
+            self._pool.release(self, reuse)
+            return
+        if self._statements and self._statements.hits + self._statements.misses:
+            self._log_statement_cache()
+        # Prepared statements end with the session
+        self._statements = None
         if self._db_connection:
             self._db_connection.close()
+            self._db_connection = None
+
+
+    def get_statement_cache(self):
+        """Get the prepared statement cache of this connection.
+
+        Returns:
+            StatementCache: The cache used by queries run with prepared.
+        """
+        if self._statements is None:
+            self._statements = prepared.StatementCache(self._db_connection)
+        return self._statements
+
+
+    def get_statement_cache_stats(self):
+        """Get the hit and miss counters of the prepared statement cache.
+
+        Returns:
+            dictionary: See StatementCache.stats().
+        """
+        return self.get_statement_cache().stats()
+
+
+    def _log_statement_cache(self):
+        stats = self._statements.stats()
+        self._logger.info(
+            "Prepared statement cache: %s hits, %s misses, %s evictions",
+            stats['hits'],
+            stats['misses'],
+            stats['evictions']
+        )
+
+
+    def ping(self):
+        """Check that the connection to the server still works.
+
+        Returns:
+            boolean: True if the server answered, False otherwise.
+        """
+        if not self._db_connection:
+            return False
+        try:
+            self._db_connection.ping()
+        except mdb.Error:
+            return False
+        return True
 
 
     def connected(self):
@@ -114,20 +211,51 @@ class Database:
         return self._database
 
 
-    def query(self, query, params=None):
+    def start_profiling(self):
+        """Record statement timings for every script run from now on.
+
+        Returns:
+            ScriptProfile: The profile that will collect the timings.
+        """
+        self._profile = sql_script.ScriptProfile()
+        return self._profile
+
+
+    def get_profile(self):
+        """Get the profile started by start_profiling() or None."""
+        return self._profile
+
+
+    def query(self, query, params=None, prepared=False, compact=False):
         """Run a MySQL query string.
 
         Args:
             query (string): MySQL query string.
+            params (tuple): Values to bind to the query placeholders.
+            prepared (boolean): Run the query as a cached server-side
+                prepared statement. Use it for queries repeated often.
+            compact (boolean): Return compact rows, which are tuples that
+                can also be read by column name, instead of dictionaries.
 
         Returns:
-            results: Results of the query as a list of tuples.
+            results: Results of the query as a list of dictionaries or
+                compact rows.
         """
         results = None
-        with closing(self._db_connection.cursor(mdb.cursors.DictCursor)) as cur:
+        if compact:
+            cursor_class = mdb.cursors.Cursor
+        else:
+            cursor_class = mdb.cursors.DictCursor
+        with closing(self._db_connection.cursor(cursor_class)) as cur:
             try:
-                cur.execute(query)
+                if prepared:
+                    self.get_statement_cache().execute(cur, query, params)
+                else:
+                    cur.execute(query, params)
                 results = cur.fetchall()
+                row_class = row_types.cursor_row_class(cur) if compact else None
+                if row_class:
+                    results = [row_class(row) for row in results]
             except (mdb.OperationalError, mdb.ProgrammingError), e:
                 # Uncomment to show error number
                 #print "Check database for problems {}: {}".format(e[0], e[1])
@@ -143,20 +271,108 @@ class Database:
         return results
 
 
+    def query_count(self, query, params=None):
+        """Run a MySQL query that returns a single number.
+
+        Use this for COUNT(*) queries so only the count is sent back
+        by the server.
+
+        Args:
+            query (string): MySQL query string.
+            params (tuple): Values to bind to the query placeholders.
+
+        Returns:
+            long: The first column of the first row, or 0 if there is none.
+        """
+        row = None
+        with closing(self._db_connection.cursor()) as cur:
+            try:
+                cur.execute(query, params)
+                row = cur.fetchone()
+            except (mdb.OperationalError, mdb.ProgrammingError), e:
+                self._logger.error(
+                    "There was a problem while trying to run a query:\n\t%s",
+                    e[1]
+                )
+                raise
+            except mdb.Warning, warn:
+                self._logger.warning("%s", warn)
+                raise
+        if not row or row[0] is None:
+            return 0
+        return row[0]
+
+
+    def iter_query(self, query, params=None, batch_size=None, batches=False,
+                   compact=False):
+        """Run a MySQL query and stream the results from the server.
+
+        Rows are fetched with a server-side cursor, so only one batch is
+        held in memory at a time. No other query can run on this
+        connection until the generator is exhausted or closed. Closing
+        it early still reads the remaining rows off the wire.
+
+        Args:
+            query (string): MySQL query string.
+            params (tuple): Values to bind to the query placeholders.
+            batch_size (integer): Number of rows fetched per round trip.
+            batches (boolean): Yield lists of rows instead of single rows.
+            compact (boolean): Yield compact rows, which are tuples that
+                can also be read by column name, instead of dictionaries.
+
+        Returns:
+            generator: Each row as a dictionary or compact row, or each
+                batch as a list.
+        """
+        if not batch_size:
+            batch_size = ITER_BATCH_SIZE
+        if compact:
+            cur = self._db_connection.cursor(mdb.cursors.SSCursor)
+        else:
+            cur = self._db_connection.cursor(mdb.cursors.SSDictCursor)
+        try:
+            cur.execute(query, params)
+            # Column names are resolved once for the whole result
+            row_class = row_types.cursor_row_class(cur) if compact else None
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                if row_class:
+                    rows = [row_class(row) for row in rows]
+                if batches:
+                    yield rows
+                else:
+                    for row in rows:
+                        yield row
+        except (mdb.OperationalError, mdb.ProgrammingError), e:
+            self._logger.error(
+                "There was a problem while trying to run a query:\n\t%s",
+                e[1]
+            )
+            raise
+        except mdb.Warning, warn:
+            self._logger.warning("%s", warn)
+            raise
+        finally:
+            cur.close()
+
+
     def insert(self, query, params=None):
         """Run a MySQL INSERT query string.
 
         Args:
             query (string): MySQL query string.
+            params (tuple): Values to bind to the query placeholders.
 
         Returns:
-            results: Results of the query.
+            boolean: True if the query was committed.
         """
         # Assume success unless an exception is raised
         success = True
         try:
-            cur = self._db_connection.cursor()
-            cur.execute(query)
+            with closing(self._db_connection.cursor()) as cur:
+                cur.execute(query, params)
             self._db_connection.commit()
         except mdb.Error, e:
             success = False
@@ -167,10 +383,283 @@ class Database:
             )
             self._logger.error("Unable to insert data; rollback called")
             self._db_connection.rollback()
-            cur.close()
         return success
 
 
+    def execute(self, query, params=None, prepared=False):
+        """Run a MySQL statement without committing it.
+
+        Args:
+            query (string): MySQL query string.
+            params (tuple): Values to bind to the query placeholders.
+            prepared (boolean): Run the statement as a cached server-side
+                prepared statement. Use it for statements repeated often.
+
+        Returns:
+            long: The number of rows affected.
+        """
+        with closing(self._db_connection.cursor()) as cur:
+            try:
+                if prepared:
+                    self.get_statement_cache().execute(cur, query, params)
+                else:
+                    cur.execute(query, params)
+            except mdb.Error, e:
+                self._logger.error(
+                    "Sorry there was an error %s: %s",
+                    e[0],
+                    e[1]
+                )
+                raise
+            return cur.rowcount
+
+
+    def execute_many(self, query, rows, batch_size=None, progress=None,
+                     commit_every=None, failed=None):
+        """Run a MySQL statement for each row of values.
+
+        The rows are sent in batches. MySQLdb rewrites an
+        INSERT ... VALUES statement into one multi-row INSERT per batch.
+        Each batch starts with a savepoint, so a failing batch is rolled
+        back on its own and the batches before it are kept.
+
+        Args:
+            query (string): MySQL query string with placeholders.
+            rows (iterable): A tuple of values for each row.
+            batch_size (integer): Number of rows sent at a time.
+            progress (ProgressMeter): Meter to update after each batch.
+            commit_every (integer): Commit whenever at least this many
+                rows have been written since the last commit. By default
+                nothing is committed.
+            failed (list): If given, the rows of a failing batch are
+                retried one at a time and each row that still fails is
+                appended to it as a (row, error) tuple instead of raising.
+
+        Returns:
+            long: The number of rows affected.
+        """
+        if not batch_size:
+            batch_size = ITER_BATCH_SIZE
+        rowcount = 0
+        done = 0
+        pending = 0
+        with closing(self._db_connection.cursor()) as cur:
+            rows = iter(rows)
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                cur.execute("SAVEPOINT " + BATCH_SAVEPOINT)
+                try:
+                    cur.executemany(query, batch)
+                except mdb.Error, e:
+                    cur.execute("ROLLBACK TO SAVEPOINT " + BATCH_SAVEPOINT)
+                    self._logger.error(
+                        "Rolled back a batch of %s rows. Error %s: %s",
+                        len(batch),
+                        e[0],
+                        e[1]
+                    )
+                    if failed is None:
+                        if commit_every:
+                            # Keep the batches that succeeded
+                            self._db_connection.commit()
+                        raise
+                    rowcount += self._execute_rows(cur, query, batch, failed)
+                else:
+                    rowcount += cur.rowcount
+                done += len(batch)
+                pending += len(batch)
+                if commit_every and pending >= commit_every:
+                    self._db_connection.commit()
+                    pending = 0
+                if progress:
+                    progress.update(done)
+        if commit_every and pending:
+            self._db_connection.commit()
+        return rowcount
+
+
+    def _execute_rows(self, cur, query, rows, failed):
+        """Run a statement one row at a time, collecting the failed rows."""
+        rowcount = 0
+        for row in rows:
+            cur.execute("SAVEPOINT " + BATCH_SAVEPOINT)
+            try:
+                cur.execute(query, row)
+            except mdb.Error, e:
+                cur.execute("ROLLBACK TO SAVEPOINT " + BATCH_SAVEPOINT)
+                failed.append((row, e))
+            else:
+                rowcount += cur.rowcount
+        if failed:
+            self._logger.error("%s rows could not be written", len(failed))
+        return rowcount
+
+
+    def load_rows(self, table, columns, rows, replace=False):
+        """Load rows built in Python into a table, without committing.
+
+        Uses LOAD DATA LOCAL INFILE through a temporary file, or
+        multi-row INSERT statements if local_infile is off on the
+        server. The row count and throughput are logged.
+
+        Args:
+            table (string): The target or staging table.
+            columns (list): The columns the values of each row go in.
+            rows (iterable): A tuple of values for each row.
+            replace (boolean): Replace rows with the same unique key.
+
+        Returns:
+            long: The rows affected as reported by the server. Rows
+                skipped as duplicates aren't counted.
+        """
+        try:
+            return bulk_writer.load_rows(
+                self._db_connection,
+                table,
+                columns,
+                rows,
+                replace
+            )
+        except mdb.Error, e:
+            self._logger.error(
+                "Sorry there was an error %s: %s",
+                e[0],
+                e[1]
+            )
+            raise
+
+
+    def execute_chunked(self, query, table, key, column=None,
+                        size=sql_script.DEFAULT_CHUNK_ROWS, pause=0):
+        """Run a huge UPDATE, DELETE or INSERT ... SELECT in key ranges.
+
+        The statement is restricted to size keys of table at a time and
+        each range is committed before the next, so an interrupted run
+        keeps the ranges that completed. Progress is logged.
+
+        Args:
+            query (string): MySQL query string.
+            table (string): The table whose key range is covered.
+            key (string): The key column of table.
+            column (string): The column the query is restricted on,
+                e.g. "n.nid". Defaults to key.
+            size (integer): Keys per transaction.
+            pause (float): Seconds to wait between ranges.
+
+        Returns:
+            long: The number of rows affected.
+        """
+        rowcount, warnings, warning = sql_script.execute_chunked(
+            self._db_connection,
+            query,
+            table,
+            key,
+            column,
+            size,
+            pause
+        )
+        return rowcount
+
+
+    def bulk_load(self, commit_every=sql_script.DEFAULT_COMMIT_EVERY):
+        """Get a bulk load session for this connection.
+
+        Use it in a with block around work that rebuilds tables from
+        scratch. Unique and foreign key checks and binary logging are
+        turned off where permitted, the sort and join buffers are
+        enlarged, and everything is restored when the block ends.
+
+        Args:
+            commit_every (integer): Statements per transaction for
+                scripts run during the session.
+
+        Returns:
+            BulkLoadSession: The session, not yet started.
+        """
+        return sql_script.BulkLoadSession(
+            self._db_connection,
+            commit_every=commit_every
+        )
+
+
+    def _borrow_connection(self, database=None, bulk_load=False):
+        """Borrow another connection for a worker thread.
+
+        The connection is a clone, so it comes from the session pool if
+        this connection belongs to one.
+
+        Args:
+            database (string): The database to use. Defaults to the
+                database of this connection.
+            bulk_load (boolean): Apply the bulk load settings until the
+                connection is handed back.
+
+        Returns:
+            tuple: The MySQLdb connection and a function that hands it
+                back. Call the function with False to close the
+                connection for good if its session state was changed.
+        """
+        worker = self.clone()
+        connection = worker._db_connection
+        previous = {}
+        try:
+            if database and database != worker._database:
+                connection.select_db(database)
+            if bulk_load:
+                previous = sql_script.apply_session_settings(
+                    connection,
+                    sql_script.BULK_LOAD_SETTINGS
+                )
+        except:
+            worker.close(False)
+            raise
+
+        def release(reuse=True):
+            if reuse:
+                try:
+                    connection.autocommit(False)
+                    sql_script.apply_session_settings(connection, [
+                        (name, previous[name])
+                        for name, value in sql_script.BULK_LOAD_SETTINGS
+                        if name in previous
+                    ])
+                    if worker._database:
+                        connection.select_db(worker._database)
+                except mdb.Error:
+                    reuse = False
+            worker.close(reuse)
+        return connection, release
+
+
+    def commit(self):
+        self._db_connection.commit()
+
+
+    def rollback(self):
+        self._db_connection.rollback()
+
+
+    @contextmanager
+    def transaction(self):
+        """Run the statements of a with block in a single transaction.
+
+        The transaction is committed when the block ends, or rolled
+        back if the block raises an exception.
+
+        Yields:
+            Database: This database.
+        """
+        try:
+            yield self
+        except:
+            self._db_connection.rollback()
+            raise
+        else:
+            self._db_connection.commit()
+
+
     def get_table_count(self, table):
         """Query to check if the table exists in the database.
 
@@ -181,13 +670,11 @@ class Database:
             long: table count
         """
         count = 0
-        query = "SELECT count(*) FROM information_schema.tables \
-                WHERE table_schema = '{0}' AND table_name = '{1}' LIMIT 1;".format(
-                    self._database,
-                    table
-                    )
-
-        result = self.query(query)
+        result = self.query(
+            "SELECT count(*) FROM information_schema.tables "
+            "WHERE table_schema = %s AND table_name = %s LIMIT 1;",
+            (self._database, table)
+        )
         dict_item = result[0]
         count = dict_item['count(*)']
         if (count > 1 ):
@@ -199,6 +686,34 @@ class Database:
         return count
         
 
+    def get_schema_tables(self, refresh=False):
+        """Get the tables of the selected database in a single query.
+
+        The result is cached on the connection so any later check can
+        reuse it. Scripts run with execute_sql_file() clear the cache.
+
+        Args:
+            refresh (boolean): Query information_schema again.
+
+        Returns:
+            dictionary: Each table name mapped to a dictionary with the
+                estimated number of 'rows' and the storage 'engine'.
+        """
+        if self._schema_tables is None or refresh:
+            schema_tables = {}
+            for row in self.iter_query(
+                    "SELECT table_name AS name, table_rows AS row_estimate, "
+                    "engine AS engine FROM information_schema.tables "
+                    "WHERE table_schema = %s",
+                    (self._database,)):
+                schema_tables[row['name']] = {
+                    'rows': row['row_estimate'] or 0,
+                    'engine': row['engine']
+                }
+            self._schema_tables = schema_tables
+        return self._schema_tables
+
+
     def get_drupal_version(self):
         """Get the Drupal installation version.
         """
@@ -255,41 +770,70 @@ class Database:
 
     def get_drupal_posts(self):
         """Get all the nodes from the Drupal installation.
+
+        The nodes are streamed from the server as they are iterated.
         """
-        posts = None
         try:
-            posts = self.query(
-                "SELECT DISTINCT "
-                "nid, FROM_UNIXTIME(created) post_date, title, type "
-                "FROM node"
-            )
+            for post in self.iter_query(
+                    "SELECT DISTINCT "
+                    "nid, FROM_UNIXTIME(created) post_date, title, type "
+                    "FROM node",
+                    compact=True):
+                yield post
         except mdb.ProgrammingError as ex:
             self._logger.error(
                 "Couldn't get posts. Perhaps your node table is missing."
             )
-        if not posts:
-            posts = ()
-        return posts
+
+
+    def count_drupal_posts(self):
+        """Count the nodes on the Drupal installation.
+        """
+        count = 0
+        try:
+            count = self.query_count(
+                "SELECT COUNT(*) FROM node"
+            )
+        except mdb.ProgrammingError:
+            self._logger.error(
+                "Couldn't count posts. Perhaps your node table is missing."
+            )
+        return count
 
 
     def get_drupal_terms(self):
         """Get all the terms from the Drupal installation.
+
+        The terms are streamed from the server as they are iterated.
         """
-        terms = None
         try:
-            terms = self.query(
-                "SELECT DISTINCT "
-                "tid, name, REPLACE(LOWER(name), ' ', '_') slug, 0 "
-                "FROM term_data WHERE (1);"
-            )
+            for term in self.iter_query(
+                    "SELECT DISTINCT "
+                    "tid, name, REPLACE(LOWER(name), ' ', '_') slug, 0 "
+                    "FROM term_data WHERE (1);",
+                    compact=True):
+                yield term
         except mdb.ProgrammingError as ex:
             self._logger.error(
                 "Couldn't get terms. "
                 "Perhaps your term_data table is missing."
             )
-        if not terms:
-            terms = ()
-        return terms
+
+
+    def count_drupal_terms(self):
+        """Count the terms on the Drupal installation.
+        """
+        count = 0
+        try:
+            count = self.query_count(
+                "SELECT COUNT(*) FROM term_data"
+            )
+        except mdb.ProgrammingError:
+            self._logger.error(
+                "Couldn't count terms. "
+                "Perhaps your term_data table is missing."
+            )
+        return count
 
 
     def get_drupal_node_types(self):
@@ -332,6 +876,68 @@ class Database:
         return node_count
 
 
+    def get_node_shape_batches(self, batch_size=None):
+        """Stream the numeric columns content statistics are built from.
+
+        Yields:
+            list: Batches of (nid, type, uid, created, body length) rows.
+        """
+        try:
+            for batch in self.iter_query(
+                    "SELECT n.nid, n.type, n.uid, n.created, "
+                    "COALESCE(LENGTH(r.body), 0) body_length "
+                    "FROM node n "
+                    "LEFT JOIN node_revisions r ON r.vid = n.vid",
+                    batch_size=batch_size,
+                    batches=True,
+                    compact=True):
+                yield batch
+        except mdb.ProgrammingError:
+            self._logger.error(
+                "Couldn't get node sizes. "
+                "Perhaps your node or node_revisions table is missing."
+            )
+
+
+    def get_comment_node_batches(self, batch_size=None):
+        """Stream the node ID of every comment on an existing node.
+
+        Yields:
+            list: Batches of (nid,) rows.
+        """
+        try:
+            for batch in self.iter_query(
+                    "SELECT c.nid FROM comments c "
+                    "INNER JOIN node n ON n.nid = c.nid",
+                    batch_size=batch_size,
+                    batches=True,
+                    compact=True):
+                yield batch
+        except mdb.ProgrammingError:
+            self._logger.error(
+                "Couldn't get comments. "
+                "Perhaps your comments table is missing."
+            )
+
+
+    def estimate_diagnostics(self, sample_size=estimates.DEFAULT_SAMPLE_SIZE):
+        """Estimate the analyse counts from table statistics and samples.
+
+        Args:
+            sample_size (integer): Rows sampled from each table.
+
+        Returns:
+            dictionary: See estimates.estimate_diagnostics().
+        """
+        return estimates.estimate_diagnostics(
+            self,
+            'term_data',
+            'url_alias',
+            'src',
+            sample_size
+        )
+
+
     def get_drupal_duplicate_term_names(self):
         """Get any duplicate term names.
 
@@ -356,30 +962,46 @@ class Database:
         return term_names
 
 
+    def count_drupal_duplicate_term_names(self):
+        """Count the term names that are used by more than one term.
+        """
+        count = 0
+        try:
+            count = self.query_count(
+                "SELECT COUNT(*) FROM ( "
+                "SELECT name FROM term_data "
+                "GROUP BY name HAVING COUNT(*) > 1 ) duplicates"
+            )
+        except mdb.ProgrammingError:
+            self._logger.error(
+                "Couldn't count term names. "
+                "Perhaps your term_data table is missing."
+            )
+        return count
+
+
     def get_drupal_duplicate_terms(self):
         """Get each individual term that has a duplicate.
 
         This is different from get_drupal_duplicate_term_names() because
-        it gets the aggregate of terms with duplicate names.
+        it gets the aggregate of terms with duplicate names. The terms
+        are streamed from the server as they are iterated.
         """
         self._logger.debug("Getting duplicate terms...")
-        duplicate_terms = None
         try:
-            duplicate_terms = self.query(
-                "SELECT term_data.tid, term_data.name "
-                "FROM term_data "
-                "INNER JOIN ( SELECT term_data.name FROM term_data "
-                "GROUP BY term_data.name, term_data.tid HAVING COUNT(name) >1 ) temp "
-                "ON term_data.name=temp.name"
-            )
+            for term in self.iter_query(
+                    "SELECT term_data.tid, term_data.name "
+                    "FROM term_data "
+                    "INNER JOIN ( SELECT term_data.name FROM term_data "
+                    "GROUP BY term_data.name, term_data.tid HAVING COUNT(name) >1 ) temp "
+                    "ON term_data.name=temp.name",
+                    compact=True):
+                yield term
         except mdb.ProgrammingError as ex:
             self._logger.error(
                 "Couldn't get dupolicate terms. "
                 "Perhaps your term_data table is missing."
             )
-        if not duplicate_terms:
-            duplicate_terms = ()
-        return duplicate_terms
 
 
     def get_terms_exceeded_charlength(self):
@@ -404,6 +1026,23 @@ class Database:
         return terms
 
 
+    def count_terms_exceeded_charlength(self):
+        """Count the terms that exceed WordPress' character length.
+        """
+        count = 0
+        try:
+            count = self.query_count(
+                "SELECT COUNT(*) "
+                "FROM term_data WHERE CHAR_LENGTH(name) > 200"
+            )
+        except mdb.ProgrammingError:
+            self._logger.error(
+                "Couldn't count terms. "
+                "Perhaps your term_data table is missing."
+            )
+        return count
+
+
     def get_duplicate_aliases(self):
         """Get any duplicate aliases.
 
@@ -437,65 +1076,178 @@ class Database:
         return aliases
         
 
-    def execute_sql_file(self, sql_file, database=None):
-        """Use mysql on the command line to execute a MySQL file.
+    def count_duplicate_aliases(self):
+        """Count the node paths that have more than one alias.
+        """
+        count = 0
+        try:
+            count = self.query_count(
+                "SELECT COUNT(*) FROM ( "
+                "SELECT src FROM url_alias "
+                "GROUP BY src HAVING COUNT(*) > 1 ) duplicates"
+            )
+        except mdb.ProgrammingError:
+            self._logger.error(
+                "Couldn't count aliases. "
+                "Perhaps your url_aliases table is missing."
+            )
+        return count
+
 
-        This will produce a warning about using the password on the
-        command line being insecure.
+    def build_node_alias_table(self):
+        """Map each node id to its URL alias in an indexed working table.
+
+        The migration joins nodes to aliases on CONCAT('node/', nid),
+        which can't use an index. acc_node_alias holds the alias of each
+        node keyed on the integer nid, with the WordPress post name
+        already derived from the last part of the alias. The alias with
+        the lowest pid is used if a node has more than one, including
+        sources such as node/01 and node/1 that name the same node.
+
+        Returns:
+            long: The number of nodes with an alias.
         """
-        success = False
+        try:
+            self.query("DROP TABLE IF EXISTS acc_node_alias;")
+        except mdb.Warning:
+            # The table doesn't exist on the first run of the migration
+            pass
+        self.query(
+            "CREATE TABLE acc_node_alias ("
+            "nid INT(10) UNSIGNED NOT NULL PRIMARY KEY, "
+            "alias VARCHAR(255) NOT NULL, "
+            "post_name VARCHAR(255) NOT NULL"
+            ") ENGINE=INNODB;"
+        )
+        count = self.execute(
+            "INSERT INTO acc_node_alias (nid, alias, post_name) "
+            "SELECT CAST(SUBSTRING(a.src, 6) AS UNSIGNED), a.dst, "
+            "SUBSTRING_INDEX(a.dst, '/', -1) "
+            "FROM url_alias a "
+            "INNER JOIN ( SELECT MIN(pid) pid FROM url_alias "
+            "WHERE src LIKE 'node/%' AND src REGEXP '^node/[0-9]+$' "
+            "GROUP BY CAST(SUBSTRING(src, 6) AS UNSIGNED) ) k ON a.pid = k.pid"
+        )
+        self.commit()
+        self._logger.info("Mapped %s node aliases", count)
+        return count
+
+
+    def execute_sql_file(self, sql_file, database=None,
+                         chunk_size=sql_script.DEFAULT_CHUNK_SIZE,
+                         use_mmap=False, checkpoint=False,
+                         from_statement=None, restart=False, workers=1,
+                         bulk_load=False):
+        """Execute a MySQL script file on the open connection.
+
+        The script is streamed, split into statements and run in-process,
+        so no mysql client process or extra connection is needed and
+        multi-gigabyte dumps load in bounded memory. Execution stops at
+        the first failing statement.
+
+        Args:
+            sql_file (string): Path to the script file. Dumps compressed
+                with gzip (.gz) or xz (.xz) are decompressed on the fly.
+            database (string): Database to run the script against.
+                Defaults to the connection's database.
+            chunk_size (integer): Bytes to read from the file at a time.
+            use_mmap (boolean): Read uncompressed files through a memory map.
+            checkpoint (boolean): Journal each completed statement so that
+                a failed run resumes from the first incomplete statement.
+            from_statement (integer): Start at this statement, ignoring
+                the journal.
+            restart (boolean): Ignore the journal and run the whole script.
+            workers (integer): Run independent @stage blocks of the script
+                at the same time on up to this many connections.
+            bulk_load (boolean): Run the script in a bulk load session on
+                every connection it uses. See bulk_load().
+
+        Returns:
+            ScriptResult: Rows affected and timings of the script, and
+                of each statement when profiling. Evaluates to True if
+                the whole script was executed.
+        """
+        result = sql_script.ScriptResult(sql_file)
+        profile = self._profile is not None
+        # The script may create or drop tables
+        self._schema_tables = None
         try:
             self._logger.debug("Executing SQL file %s...", sql_file)
+            journal = None
+            if checkpoint and (database or self._database):
+                journal = sql_script.ScriptJournal(
+                    self._db_connection,
+                    str(database or self._database),
+                    sql_file
+                )
+                if restart and not from_statement:
+                    from_statement = 1
+            if database and str(database) != self._database:
+                self._db_connection.select_db(str(database))
+            session = None
+            if bulk_load:
+                session = self.bulk_load()
+            # Stage workers use the same database as this connection
+            connect = lambda: self._borrow_connection(
+                str(database) if database else None,
+                bulk_load
+            )
+            try:
+                if session:
+                    session.start()
+                if workers > 1:
+                    result = stages.execute_file(
+                        self._db_connection,
+                        connect,
+                        sql_file,
+                        workers,
+                        journal,
+                        from_statement,
+                        profile,
+                        chunk_size,
+                        use_mmap,
+                        session.commit_every if session else None
+                    )
+                else:
+                    result = sql_script.execute_file(
+                        self._db_connection,
+                        sql_file,
+                        chunk_size,
+                        use_mmap,
+                        journal,
+                        from_statement,
+                        session.commit_every if session else None,
+                        profile
+                    )
+            finally:
+                if session:
+                    session.stop()
+                # The script may have switched databases with USE
+                if self._database:
+                    self._db_connection.select_db(self._database)
+            if self._profile is not None:
+                self._profile.add(result)
 
-            user = str(self._user)
-            password = str(self._password)
-            
-            if database is None:
-                # Support connections where database has yet to be created
-                process = subprocess.Popen(
-                    ["mysql",
-                    "-u"+ user,
-                    "-p"+ password
-                    ],
-                    stdout=subprocess.PIPE,
-                    stdin=subprocess.PIPE,
-                    stderr=subprocess.PIPE
+            if result:
+                self._logger.debug(
+                    "...done: %s statements, %s rows in %.2fs",
+                    result.executed,
+                    result.rowcount,
+                    result.elapsed
                 )
             else:
-                database = str(database)
-                process = subprocess.Popen(
-                    ["mysql",
-                    "-u"+ user,
-                    "-p"+ password,
-                    database
-                    ],
-                    stdout=subprocess.PIPE,
-                    stdin=subprocess.PIPE,
-                    stderr=subprocess.PIPE
-                )
-                
-            out, err = process.communicate(file(sql_file).read())
-            
-            if process.returncode == 0:
-                self._logger.debug("...done")
-                success = True
-            elif process.returncode == 1:
                 self._logger.info(
-                    "There were problems with executing the script:\n\n%s",
-                    err
-                )
-            else:
-                assert process.returncode > 1
-                self._logger.error(
-                    "Error while executing the script: %s", error
+                    "There were problems with executing the script "
+                    "at statement %s (lines %s-%s):\n\n%s",
+                    result.failed_statement.index,
+                    result.failed_statement.first_line,
+                    result.failed_statement.last_line,
+                    result.error
                 )
-        except IOError:
-            self._logger.error("...could not find file. Aborting.")
-        except Exception as ex:
-            template = "A {0} exception occured:\n{1!r}"
-            message = template.format(type(ex).__name__, ex.args)
-            raise
-        return success
+        except sql_script.READ_ERRORS as err:
+            self._logger.error("...could not read file: %s. Aborting.", err)
+            result.error = err
+        return result
 
 
     def __del__(self):
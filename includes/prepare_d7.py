@@ -12,14 +12,20 @@ from MySQLdb import OperationalError
 from d2w import run_sql_script
 import os, subprocess
 import display_cli as cli
+import term_names
 
+# Passes made to rename term names the server still finds duplicated
+MAX_DUPLICATE_PASSES = 5
 
-def prepare_migration(settings, dbconn, database=None):
+
+def prepare_migration(settings, dbconn, database=None, restart=False):
     """Prepare the working database.
 
     Args:
         dbconn: An open connection to the Drupal database.
         database: The database to prepare.
+        restart: Run the whole prepare script even if an earlier run
+            stopped part way through.
         
     Returns:
         True if prepare process completed without problems
@@ -37,7 +43,12 @@ def prepare_migration(settings, dbconn, database=None):
             print "Could not find custom prepare script."
         else:
             if os.path.isfile(custom_sql):
-                prepared = dbconn.execute_sql_file(custom_sql, database)
+                prepared = dbconn.execute_sql_file(
+                    custom_sql,
+                    database,
+                    checkpoint=True,
+                    restart=restart
+                )
             else:
                 print "No custom prepare SQL found at {}".format(custom_sql)
             #################################
@@ -67,16 +78,15 @@ def run_fix(dbconn):
     success = False
     print "Trying to fix any issues that would cause the migration to fail."
     try:
-        # Warning: this may push the name length past WordPress' 200 char limit
-        terms_with_duplicate_names = dbconn.get_drupal_duplicate_terms()
-        fixed_term_names = process_duplicate_term_names(
-            terms_with_duplicate_names
-        )
-        for term in fixed_term_names:
-            update_processed_term_name(dbconn, term["tid"], term["name"])
-        # Warning: this may undo duplicates fix if the term was close to the 200 char limit
-        update_term_name_length(dbconn)
-        success = uniquify_url_aliases(dbconn)
+        # Duplicates and WordPress' 200 char limit are fixed together
+        fixed_term_names = process_term_names(dbconn)
+        update_processed_term_names(dbconn, fixed_term_names)
+        # The server's collation has the last word on duplicates
+        rename_remaining_duplicates(dbconn)
+        if uniquify_url_aliases(dbconn):
+            # Lets the migration join nodes to their aliases on nid
+            dbconn.build_node_alias_table()
+            success = True
     except OperationalError:
         print "Could not access the database. Aborting attempt to fix database."
     except Warning as warn:
@@ -92,28 +102,29 @@ def run_fix(dbconn):
     return success
 
 
-def process_duplicate_term_names(duplicate_term_names):
-    """Create unique term names by appending the term id.
+def process_term_names(dbconn):
+    """Find unique term names that fit WordPress' 200 character limit.
+
+    The terms are read once, in term id order, so the lowest term id
+    keeps a duplicated name and later terms have their id appended.
 
     Args:
-        drupal_terms_with_duplicate_names (list): A list of Drupal terms.
+        dbconn: An open connection to the Drupal database.
 
     Returns:
-        updated_terms (list): A list of Drupal terms comaptible with WordPress.
+        list: Dictionaries with the tid and new name of each term that
+            must be renamed.
     """
-    print "Processing duplicate term names"
-    updated_terms = list()
-    duplicate_terms_count = len(duplicate_term_names)
-    if duplicate_terms_count > 0:
-        print "Creating unique term names by appending the term id..."
-        for term in duplicate_term_names:
-            term_attributes_list = {'tid': term["tid"], 'name': term["name"]+"_"+str(term["tid"])}
-            print "tid {}: {}".format(term_attributes_list["tid"], term_attributes_list["name"])
-            updated_terms.append(term_attributes_list)
+    print "Processing term names"
+    fixed_term_names = term_names.uniquify(
+        dbconn.iter_query("SELECT tid, name FROM taxonomy_term_data ORDER BY tid;", compact=True)
+    )
+    if fixed_term_names:
+        print "{} term names need to change".format(len(fixed_term_names))
     else:
-        print "No duplicate term names"
-    return updated_terms
-    
+        print "No duplicate or overlong term names"
+    return fixed_term_names
+
 
 def create_working_tables(dbconn):
     """Create some working tables to hold temporary data.
@@ -124,72 +135,125 @@ def create_working_tables(dbconn):
         dbconn: An open connection to the Drupal database.    
     """
     print "Creating working tables"
-    dbconn.query("CREATE TABLE IF NOT EXISTS acc_fixed_term_names ( \
+    try:
+        dbconn.query("CREATE TABLE IF NOT EXISTS acc_fixed_term_names ( \
                     tid INT(10) NOT NULL UNIQUE, name VARCHAR(255)) ENGINE=INNODB;")
+    except Warning:
+        # In this case it's OK not to raise an exception on the warning
+        # The table already exists after the first run of the migration
+        pass
 
 
 def uniquify_url_aliases(dbconn):
     """Remove duplicate aliases but keep a copy in a working table.
 
     URL alias will be used as the WordPress post slug but these need to be unique.
-    Create a url_alias table of unique aliases and keep a copy of the original
-    for later processing.
+    The alias with the lowest pid is kept for each path. Only the surplus
+    rows are deleted, so url_alias keeps its indexes, and they are copied
+    to acc_url_alias_duplicates first. Running it again once the
+    duplicates are gone changes nothing.
     """
     success = True
     print "Uniquifing URL aliases"
     try:
-        dbconn.query("DROP TABLE IF EXISTS acc_url_alias_dups_removed;")
-    except Warning as warn:
-        # In this case it's OK not to raise an exception on the warning
-        # The table may not exist on the first run of the migration
-        pass
-
-    try:
-        dbconn.query("DROP TABLE IF EXISTS acc_url_alias_with_dups;")
+        dbconn.query("CREATE TABLE IF NOT EXISTS acc_url_alias_duplicates ( \
+                    pid INT(10) UNSIGNED NOT NULL PRIMARY KEY, \
+                    source VARCHAR(255) NOT NULL, alias VARCHAR(255) NOT NULL) ENGINE=INNODB;")
     except Warning as warn:
         # In this case it's OK not to raise an exception on the warning
-        # The table may not exist on the first run of the migration
+        # The table already exists after the first run of the migration
         pass
 
+    # The surplus aliases of each path with more than one alias
+    surplus_aliases = "FROM url_alias a \
+                    INNER JOIN ( SELECT source, MIN(pid) pid FROM url_alias \
+                    GROUP BY source HAVING COUNT(*) > 1 ) k \
+                    ON a.source = k.source AND a.pid > k.pid"
     try:
-        dbconn.query("CREATE TABLE acc_url_alias_dups_removed \
-                    AS SELECT pid, source, alias FROM url_alias GROUP BY source;")
-    except Warning as warn:
-        print "There were warnings. Fix may not have completed cleanly."
-        print "{}".format(warn)
-        success = False        
-
-    try:
-        dbconn.query("RENAME TABLE url_alias TO acc_url_alias_with_dups;")
-    except Warning as warn:
-        print "There were warnings. Fix may not have completed cleanly."
-        print "{}".format(warn)
-        success = False
-                
-    try:    
-        dbconn.query("RENAME TABLE acc_url_alias_dups_removed TO url_alias;")
+        dbconn.execute("INSERT INTO acc_url_alias_duplicates (pid, source, alias) \
+                    SELECT a.pid, a.source, a.alias " + surplus_aliases + " \
+                    ON DUPLICATE KEY UPDATE source = VALUES(source), alias = VALUES(alias);")
+        removed = dbconn.execute("DELETE a " + surplus_aliases + ";")
+        dbconn.commit()
     except Warning as warn:
+        dbconn.rollback()
         print "There were warnings. Fix may not have completed cleanly."
         print "{}".format(warn)
         success = False
+    except:
+        dbconn.rollback()
+        raise
+    else:
+        print "Removed {} duplicate aliases".format(removed)
 
     return success
 
 
-def update_processed_term_name(dbconn, tid, name):
-    """Insert term names that have been processed to meet WordPress' criteria.
+def update_processed_term_names(dbconn, terms):
+    """Rename terms in bulk to names that meet WordPress' criteria.
 
-    Args:
-        tid (integer): The Drupal taxonomy ID.
-        name (string): The Drupal taxonomy name.
-    """
-    query = "UPDATE taxonomy_term_data SET name='"+name+"' WHERE tid="+str(tid)+";"
-    return dbconn.insert(query)
+    The new names are bulk loaded into acc_fixed_term_names and applied
+    with one joined UPDATE, all in a single transaction.
 
+    Args:
+        dbconn: An open connection to the Drupal database.
+        terms (list): Dictionaries with the tid and new name of each term.
 
-def update_term_name_length(dbconn):
-    """Truncate term name to fit WordPress' 200 character limit
+    Returns:
+        long: The number of terms renamed.
     """
-    dbconn.query("UPDATE taxonomy_term_data SET name=SUBSTRING(name, 1, 200);")
+    renamed = 0
+    if terms:
+        # Creating the table commits implicitly so do it first
+        create_working_tables(dbconn)
+        with dbconn.transaction():
+            dbconn.execute("DELETE FROM acc_fixed_term_names;")
+            dbconn.load_rows(
+                "acc_fixed_term_names",
+                ("tid", "name"),
+                ((term["tid"], term["name"]) for term in terms)
+            )
+            renamed = dbconn.execute("UPDATE taxonomy_term_data t \
+                INNER JOIN acc_fixed_term_names f ON f.tid = t.tid \
+                SET t.name = f.name;")
+        print "Renamed {} terms".format(renamed)
+    return renamed
+
+
+def rename_remaining_duplicates(dbconn):
+    """Rename terms whose names the server still finds duplicated.
+
+    term_names.collation_key only approximates the collation of the
+    table, so after the fixed names are applied the server is asked for
+    names used more than once. The lowest term id keeps the name and the
+    other terms have their id appended.
+
+    Args:
+        dbconn: An open connection to the Drupal database.
 
+    Returns:
+        long: The number of terms renamed.
 
+    Raises:
+        ValueError: Names were still duplicated after MAX_DUPLICATE_PASSES.
+    """
+    renamed = 0
+    for count in range(1, MAX_DUPLICATE_PASSES + 1):
+        leftovers = dbconn.query("SELECT t.tid, t.name FROM taxonomy_term_data t \
+            INNER JOIN ( SELECT name, MIN(tid) tid FROM taxonomy_term_data \
+            GROUP BY name HAVING COUNT(*) > 1 ) d \
+            ON t.name = d.name AND t.tid > d.tid \
+            ORDER BY t.tid;")
+        if not leftovers:
+            return renamed
+        print "{} term names are still duplicated".format(len(leftovers))
+        renamed += update_processed_term_names(dbconn, [
+            {
+                'tid': term['tid'],
+                'name': term_names.suffixed_name(term['name'], term['tid'], count)
+            }
+            for term in leftovers
+        ])
+    raise ValueError(
+        "Term names were still duplicated after {} passes".format(MAX_DUPLICATE_PASSES)
+    )
@@ -0,0 +1,249 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Drop secondary indexes before a bulk load and rebuild them afterwards.
+
+Loading millions of rows is much faster when the non-unique indexes of
+the target tables are built once at the end instead of updated row by
+row. The definitions of the dropped indexes are saved in the
+acc_deferred_indexes table first, so they can still be rebuilt after a
+crash: the next call to rebuild_indexes() adds back whatever is missing.
+
+Primary keys and unique indexes are never dropped because REPLACE and
+INSERT IGNORE statements rely on them.
+"""
+
+import time
+import logging
+import threading
+import Queue
+import MySQLdb as mdb
+
+logger = logging.getLogger(__name__)
+
+# Tables loaded by the migration script
+DEFAULT_TABLES = [
+    'acc_wp_posts',
+    'acc_wp_postmeta',
+    'acc_wp_comments',
+    'acc_wp_term_relationships',
+]
+DEFAULT_WORKERS = 4
+
+
+def _quote(name):
+    return "`" + name.replace("`", "``") + "`"
+
+
+def get_secondary_indexes(dbconn, tables):
+    """Get the definitions of the non-unique indexes of some tables.
+
+    Args:
+        dbconn: An open connection to the database holding the tables.
+        tables (list): Table names.
+
+    Returns:
+        dictionary: Each table mapped to a list of (index name,
+            definition) tuples, where the definition can follow ADD in
+            an ALTER TABLE statement.
+    """
+    indexes = {}
+    if not tables:
+        return indexes
+    columns = {}
+    index_types = {}
+    for row in dbconn.iter_query(
+            "SELECT table_name AS table_name, index_name AS index_name, "
+            "column_name AS column_name, sub_part AS sub_part, "
+            "index_type AS index_type FROM information_schema.statistics "
+            "WHERE table_schema = DATABASE() AND non_unique = 1 "
+            "AND table_name IN (" + ", ".join(["%s"] * len(tables)) + ") "
+            "ORDER BY table_name, index_name, seq_in_index",
+            tuple(tables)):
+        key = (row['table_name'], row['index_name'])
+        column = _quote(row['column_name'])
+        if row['sub_part']:
+            column += "({})".format(row['sub_part'])
+        columns.setdefault(key, []).append(column)
+        index_types[key] = row['index_type']
+    for (table, index), index_columns in sorted(columns.items()):
+        kind = "INDEX"
+        if index_types[(table, index)] in ('FULLTEXT', 'SPATIAL'):
+            kind = index_types[(table, index)] + " INDEX"
+        indexes.setdefault(table, []).append((
+            index,
+            "{} {} ({})".format(kind, _quote(index), ", ".join(index_columns))
+        ))
+    return indexes
+
+
+def _create_journal(dbconn):
+    try:
+        dbconn.query(
+            "CREATE TABLE IF NOT EXISTS acc_deferred_indexes ("
+            "table_name VARCHAR(64) NOT NULL, "
+            "index_name VARCHAR(64) NOT NULL, "
+            "definition TEXT NOT NULL, "
+            "PRIMARY KEY (table_name, index_name)"
+            ") ENGINE=INNODB;"
+        )
+    except mdb.Warning:
+        # The table already exists
+        pass
+
+
+def drop_indexes(dbconn, tables=None):
+    """Save and drop the non-unique indexes of the target tables.
+
+    Args:
+        dbconn: An open connection to the database holding the tables.
+        tables (list): Table names. Defaults to DEFAULT_TABLES.
+
+    Returns:
+        integer: The number of indexes dropped.
+    """
+    if tables is None:
+        tables = DEFAULT_TABLES
+    _create_journal(dbconn)
+    indexes = get_secondary_indexes(dbconn, tables)
+    # Save every definition before anything is dropped
+    dbconn.execute_many(
+        "INSERT INTO acc_deferred_indexes (table_name, index_name, definition) "
+        "VALUES (%s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE definition = VALUES(definition)",
+        [
+            (table, index, definition)
+            for table, table_indexes in indexes.items()
+            for index, definition in table_indexes
+        ]
+    )
+    dbconn.commit()
+    dropped = 0
+    for table, table_indexes in sorted(indexes.items()):
+        dbconn.execute(
+            "ALTER TABLE {} {}".format(
+                _quote(table),
+                ", ".join(
+                    "DROP INDEX " + _quote(index)
+                    for index, definition in table_indexes
+                )
+            )
+        )
+        dropped += len(table_indexes)
+        logger.info(
+            "Deferred %s indexes of %s: %s",
+            len(table_indexes),
+            table,
+            ", ".join(index for index, definition in table_indexes)
+        )
+    return dropped
+
+
+def _rebuild_tables(dbconn, tasks, results):
+    """Rebuild the indexes of tables from the task queue until it is empty."""
+    while True:
+        try:
+            table, definitions = tasks.get_nowait()
+        except Queue.Empty:
+            break
+        start = time.time()
+        try:
+            dbconn.execute(
+                "ALTER TABLE {} {}".format(
+                    _quote(table),
+                    ", ".join("ADD " + definition for definition in definitions)
+                )
+            )
+        except Exception as ex:
+            results.put((table, time.time() - start, ex))
+        else:
+            results.put((table, time.time() - start, None))
+
+
+def rebuild_indexes(dbconn, workers=DEFAULT_WORKERS):
+    """Add back every saved index that is missing.
+
+    The indexes of each table are added with a single ALTER TABLE, and
+    up to workers tables are rebuilt at the same time on separate
+    connections. Saved definitions are removed once their table is
+    rebuilt, or if the table no longer exists.
+
+    Args:
+        dbconn: An open connection to the database holding the tables.
+        workers (integer): Maximum number of tables rebuilt at once.
+
+    Returns:
+        boolean: True if every index was rebuilt.
+    """
+    _create_journal(dbconn)
+    saved = {}
+    for row in dbconn.query(
+            "SELECT table_name, index_name, definition "
+            "FROM acc_deferred_indexes ORDER BY table_name, index_name"):
+        saved.setdefault(row['table_name'], []).append(
+            (row['index_name'], row['definition'])
+        )
+    if not saved:
+        return True
+
+    schema_tables = dbconn.get_schema_tables(refresh=True)
+    present = get_secondary_indexes(
+        dbconn,
+        [table for table in saved if table in schema_tables]
+    )
+    tasks = Queue.Queue()
+    for table, table_indexes in sorted(
+            saved.items(),
+            key=lambda item: -schema_tables.get(item[0], {}).get('rows', 0)):
+        existing = set(index for index, definition in present.get(table, []))
+        missing = [
+            definition for index, definition in table_indexes
+            if index not in existing
+        ]
+        if table in schema_tables and missing:
+            tasks.put((table, missing))
+        else:
+            # Already rebuilt, e.g. because the script recreated the table
+            _forget(dbconn, table)
+
+    results = Queue.Queue()
+    count = tasks.qsize()
+    connections = [dbconn]
+    try:
+        while len(connections) < min(int(workers), count):
+            try:
+                connections.append(dbconn.clone())
+            except mdb.OperationalError:
+                break
+        threads = []
+        for connection in connections:
+            thread = threading.Thread(
+                target=_rebuild_tables,
+                args=(connection, tasks, results)
+            )
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+    finally:
+        for connection in connections[1:]:
+            connection.close()
+
+    success = True
+    while not results.empty():
+        table, elapsed, error = results.get()
+        if error is None:
+            logger.info("Rebuilt the indexes of %s in %.1fs", table, elapsed)
+            _forget(dbconn, table)
+        else:
+            logger.error("Could not rebuild the indexes of %s: %s", table, error)
+            success = False
+    return success
+
+
+def _forget(dbconn, table):
+    dbconn.execute(
+        "DELETE FROM acc_deferred_indexes WHERE table_name = %s",
+        (table,)
+    )
+    dbconn.commit()
@@ -6,15 +6,189 @@ This module contains the logic to run the migration.
 """
 
 import os, subprocess
+from MySQLdb import Error, OperationalError, ProgrammingError, Warning
 import display_cli as cli
+import sql_script
+import indexes
 
+# Counters recalculated by the recount stage:
+# (table, key, counter, counted table, counted table key, counted column)
+COUNTERS = [
+    (
+        'acc_wp_posts', 'ID', 'comment_count',
+        'acc_wp_comments', 'comment_post_ID', 'comment_post_ID'
+    ),
+    (
+        'acc_wp_term_taxonomy', 'term_taxonomy_id', 'count',
+        'acc_wp_term_relationships', 'term_taxonomy_id', 'object_id'
+    ),
+]
 
-def run_migration(settings, dbconn, database=None):
+
+def get_migration_workers(settings):
+    """Get the number of connections for running migration stages.
+
+    Returns:
+        integer: The migration_workers setting, or 1 to run serially.
+    """
+    try:
+        workers = int(settings['d2w']['migration_workers'])
+    except (KeyError, TypeError, ValueError):
+        workers = 1
+    return max(workers, 1)
+
+
+def get_recount_chunk_size(settings):
+    """Get the number of keys updated at a time by the recount stage.
+
+    Returns:
+        integer: The recount_chunk_size setting, or 0 to update each
+            table in a single statement.
+    """
+    try:
+        chunk_size = int(settings['d2w']['recount_chunk_size'])
+    except (KeyError, TypeError, ValueError):
+        chunk_size = 0
+    return max(chunk_size, 0)
+
+
+def get_deferred_index_tables(settings):
+    """Get the tables whose secondary indexes are built after the migration.
+
+    Returns:
+        list: The deferred_index_tables setting, or the default tables
+            if it isn't set. An empty list turns deferral off.
+    """
+    tables = (settings.get('d2w') or {}).get('deferred_index_tables')
+    if tables is None:
+        tables = indexes.DEFAULT_TABLES
+    return list(tables)
+
+
+def get_index_workers(settings):
+    """Get the number of tables whose indexes are rebuilt at the same time.
+
+    Returns:
+        integer: The index_workers setting, at least 1.
+    """
+    try:
+        workers = int(settings['d2w']['index_workers'])
+    except (KeyError, TypeError, ValueError):
+        workers = indexes.DEFAULT_WORKERS
+    return max(workers, 1)
+
+
+def recount_counter(dbconn, counter, chunk_size=0):
+    """Recalculate one counter column from a grouped aggregate.
+
+    The counted rows are grouped once and joined back to the table in a
+    single UPDATE. If chunk_size is set, the UPDATE is repeated for
+    ranges of chunk_size keys with a commit after each range.
+
+    Args:
+        dbconn: An open connection to the Drupal database.
+        counter (tuple): One of the COUNTERS.
+        chunk_size (integer): Keys per UPDATE, or 0 for a single UPDATE.
+
+    Returns:
+        long: The number of rows whose counter changed.
+    """
+    table, key, column, counted_table, counted_key, counted_column = counter
+    query = (
+        "UPDATE {table} t "
+        "LEFT JOIN ( SELECT {counted_key} counted_key, "
+        "COUNT({counted_column}) total FROM {counted_table} {where} "
+        "GROUP BY {counted_key} ) c ON c.counted_key = t.{key} "
+        "SET t.{column} = COALESCE(c.total, 0) {target_where}"
+    )
+    names = dict(
+        table=table,
+        key=key,
+        column=column,
+        counted_table=counted_table,
+        counted_key=counted_key,
+        counted_column=counted_column
+    )
+    if not chunk_size:
+        changed = dbconn.execute(query.format(where="", target_where="", **names))
+        dbconn.commit()
+        return changed
+
+    bounds = dbconn.query(
+        "SELECT MIN({key}) low, MAX({key}) high FROM {table}".format(**names)
+    )
+    low, high = bounds[0]['low'], bounds[0]['high']
+    changed = 0
+    if low is None:
+        return changed
+    query = query.format(
+        where="WHERE {counted_key} BETWEEN %s AND %s".format(**names),
+        target_where="WHERE t.{key} BETWEEN %s AND %s".format(**names),
+        **names
+    )
+    progress = sql_script.ProgressMeter(
+        "Recounting {}.{}".format(table, column),
+        high - low + 1,
+        units="keys"
+    )
+    start = low
+    while start <= high:
+        end = start + chunk_size - 1
+        # The same UPDATE runs for every range, so parse it only once
+        changed += dbconn.execute(query, (start, end, start, end), prepared=True)
+        dbconn.commit()
+        progress.update(min(end, high) - low + 1)
+        start = end + 1
+    return changed
+
+
+def recount(dbconn, chunk_size=0):
+    """Recalculate the comment counts of posts and the counts of terms.
+
+    Run this after the migration script, or on its own after fixing
+    the migrated content by hand.
+
+    Args:
+        dbconn: An open connection to the Drupal database.
+        chunk_size (integer): Keys per UPDATE, or 0 for a single UPDATE
+            per table.
+
+    Returns:
+        True if every counter was recalculated.
+    """
+    success = True
+    for counter in COUNTERS:
+        try:
+            changed = recount_counter(dbconn, counter, chunk_size)
+        except (OperationalError, ProgrammingError) as ex:
+            dbconn.rollback()
+            print "Could not recount {}.{}: {}".format(counter[0], counter[2], ex)
+            success = False
+            break
+        else:
+            print "...{}.{}: {} rows updated".format(counter[0], counter[2], changed)
+    return success
+
+
+def run_migration(settings, dbconn, database=None, restart=False,
+                  from_statement=None):
     """Migrate drupal
 
     Args:
         database: An open connection to the Drupal database.
-        
+        restart: Run the whole migration script even if an earlier run
+            stopped part way through.
+        from_statement: Start the migration script at this statement.
+
+    If an earlier run failed, the migration script resumes from the
+    first statement that didn't complete. Independent @stage blocks of
+    the script run in parallel if migration_workers is more than 1.
+    Post comment counts and term counts are recalculated afterwards.
+
+    The secondary indexes of the deferred_index_tables are dropped
+    before the script runs and rebuilt once it has finished, whether or
+    not it succeeded. A database error while dropping them stops the
+    migration, after whatever was dropped has been rebuilt.
     """
     migrated = False
 
@@ -24,7 +198,32 @@ def run_migration(settings, dbconn, database=None):
         print "Could not find custom migrate script."
     else:
         if os.path.isfile(custom_sql):
-            migrated = dbconn.execute_sql_file(custom_sql, database)
+            deferred_tables = get_deferred_index_tables(settings)
+            try:
+                if deferred_tables:
+                    dropped = indexes.drop_indexes(dbconn, deferred_tables)
+                    print "Dropped {} secondary indexes until the migration finishes".format(dropped)
+                migrated = dbconn.execute_sql_file(
+                    custom_sql,
+                    database,
+                    checkpoint=True,
+                    from_statement=from_statement,
+                    restart=restart,
+                    workers=get_migration_workers(settings),
+                    bulk_load=(settings.get('d2w') or {}).get('bulk_load', False)
+                )
+            except (Error, Warning) as ex:
+                print "There was a database error during the migration: {}".format(ex)
+                migrated = False
+            finally:
+                # Also picks up indexes left dropped by an interrupted run
+                print "Rebuilding secondary indexes"
+                if not indexes.rebuild_indexes(dbconn, get_index_workers(settings)):
+                    print "Some indexes could not be rebuilt; they will be retried on the next migration"
+                    migrated = False
+            if migrated:
+                print "Recounting comments and terms"
+                migrated = recount(dbconn, get_recount_chunk_size(settings))
         else:
             print "No custom migrate SQL found at {}".format(custom_sql)
         #################################
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Cache server-side prepared statements for repeated queries.
+
+MySQLdb binds parameters by quoting them into the SQL text, so the
+server parses a repeated statement again on every call. A statement
+run through StatementCache is prepared once with PREPARE and then run
+with EXECUTE, which skips parsing and planning for complex statements
+run many times, such as chunked UPDATEs.
+
+Prepared statements belong to a session, so each connection needs its
+own cache. The least recently used statement is deallocated once the
+cache is full.
+"""
+
+import re
+import logging
+from collections import OrderedDict
+from contextlib import closing
+
+logger = logging.getLogger(__name__)
+
+# Prepared statements kept per connection
+DEFAULT_CACHE_SIZE = 32
+
+# MySQLdb placeholders and escaped percent signs
+_PLACEHOLDER = re.compile(r"%([s%])")
+
+
+def to_server_placeholders(query):
+    """Rewrite a MySQLdb query for PREPARE.
+
+    %s placeholders become ? and %% becomes %. Question marks must not
+    appear anywhere else in the query.
+
+    Args:
+        query (string): MySQL query string with %s placeholders.
+
+    Returns:
+        string: The query with ? placeholders.
+    """
+    return _PLACEHOLDER.sub(
+        lambda match: "?" if match.group(1) == "s" else "%",
+        query
+    )
+
+
+class StatementCache(object):
+    """LRU cache of prepared statements on one connection, keyed by SQL.
+
+    Attributes:
+        size (integer): Maximum number of statements kept prepared.
+        hits (integer): Calls that reused a prepared statement.
+        misses (integer): Calls that had to prepare their statement.
+        evictions (integer): Statements deallocated to make room.
+    """
+
+    def __init__(self, connection, size=DEFAULT_CACHE_SIZE):
+        self.connection = connection
+        self.size = max(int(size), 1)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._statements = OrderedDict()
+        self._next_id = 0
+
+    def _prepare(self, cur, query):
+        """Get the name of the statement prepared for query."""
+        name = self._statements.pop(query, None)
+        if name is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            if len(self._statements) >= self.size:
+                oldest, oldest_name = self._statements.popitem(last=False)
+                cur.execute("DEALLOCATE PREPARE " + oldest_name)
+                self.evictions += 1
+            self._next_id += 1
+            name = "d2w_stmt_{}".format(self._next_id)
+            cur.execute(
+                "PREPARE " + name + " FROM %s",
+                (to_server_placeholders(query),)
+            )
+        # Most recently used last
+        self._statements[query] = name
+        return name
+
+    def execute(self, cur, query, params=None):
+        """Run a query through its prepared statement.
+
+        Args:
+            cur: A cursor of the cache's connection.
+            query (string): MySQL query string with %s placeholders.
+            params (tuple): Values to bind to the placeholders.
+
+        Returns:
+            long: The number of rows affected or returned.
+        """
+        name = self._prepare(cur, query)
+        params = tuple(params or ())
+        if not params:
+            return cur.execute("EXECUTE " + name)
+        variables = ["@d2w_p{}".format(index) for index in range(len(params))]
+        cur.execute(
+            "SET " + ", ".join(variable + " = %s" for variable in variables),
+            params
+        )
+        return cur.execute("EXECUTE " + name + " USING " + ", ".join(variables))
+
+    def clear(self):
+        """Deallocate every prepared statement."""
+        with closing(self.connection.cursor()) as cur:
+            for name in self._statements.values():
+                cur.execute("DEALLOCATE PREPARE " + name)
+        self._statements.clear()
+
+    def stats(self):
+        """Get the cache counters.
+
+        Returns:
+            dictionary: hits, misses, evictions, the number of prepared
+                statements and the hit ratio.
+        """
+        calls = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'prepared': len(self._statements),
+            'hit_ratio': float(self.hits) / calls if calls else 0.0,
+        }
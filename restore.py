@@ -0,0 +1,252 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Restore a database dump in parallel.
+
+This module splits a mysqldump file into one script per table and loads
+the tables concurrently over several connections. The largest tables
+are started first so they don't hold up the end of the restore.
+
+Splitting needs temporary disk space roughly the size of the
+uncompressed dump.
+"""
+
+import os
+import re
+import time
+import shutil
+import logging
+import tempfile
+import multiprocessing
+from MySQLdb import OperationalError
+import sql_script
+from database_interface import Database
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+
+# Tables that are usually the largest in a Drupal dump
+PRIORITY_TABLES = [
+    'node_revisions',
+    'node_revision',
+    'comments',
+    'comment',
+    'url_alias',
+    'field_data_body',
+    'field_revision_body',
+    'watchdog',
+    'search_index',
+]
+
+# Statements that belong to a single table in a mysqldump file
+_TABLE_STATEMENT = re.compile(
+    r"^(?:/\*!\d+\s*)?"
+    r"(?:DROP\s+TABLE(?:\s+IF\s+EXISTS)?"
+    r"|CREATE\s+TABLE(?:\s+IF\s+NOT\s+EXISTS)?"
+    r"|LOCK\s+TABLES"
+    r"|ALTER\s+TABLE"
+    r"|INSERT(?:\s+IGNORE)?\s+INTO"
+    r"|REPLACE\s+INTO)"
+    r"\s+`?(\w+)`?",
+    re.IGNORECASE
+)
+# Views, triggers and routines must wait until every table is loaded
+_DEFERRED_STATEMENT = re.compile(
+    r"^(?:/\*!\d+\s*)?(?:CREATE|DROP|ALTER)\b[^(]*?"
+    r"(?<!`)\b(?:VIEW|TRIGGER|PROCEDURE|FUNCTION|EVENT|DATABASE)\b(?!`)",
+    re.IGNORECASE
+)
+_USE_STATEMENT = re.compile(r"^USE\s", re.IGNORECASE)
+
+
+class DumpSplit(object):
+    """The parts of a dump file after splitting it by table.
+
+    Attributes:
+        directory (string): Temporary directory holding the table scripts.
+        preamble (string): Path to the session setup run before each table.
+        tables (list): (table, path, size) tuples in load order.
+        deferred (string): Path to the script run after all tables,
+            for views, triggers and routines.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.preamble = os.path.join(directory, "_preamble.sql")
+        self.deferred = os.path.join(directory, "_deferred.sql")
+        self.tables = []
+
+    def cleanup(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def split_dump(dump_file, directory=None):
+    """Split a mysqldump file into one script per table.
+
+    Session settings that appear before the first table form a preamble
+    that is run on every connection. Statements for views, triggers and
+    routines are deferred until all tables are loaded.
+
+    Args:
+        dump_file (string): Path to the dump, optionally gzip or xz
+            compressed.
+        directory (string): Where to create the temporary directory.
+
+    Returns:
+        DumpSplit: The split dump. Call cleanup() when done.
+    """
+    split = DumpSplit(tempfile.mkdtemp(prefix="d2w_restore_", dir=directory))
+    paths = {}
+    current_table = None
+    out = None
+    preamble = open(split.preamble, 'wb')
+    # DELIMITER ;; keeps routine bodies intact when the script is re-read
+    deferred = open(split.deferred, 'wb')
+    deferred.write("DELIMITER ;;\n")
+
+    progress = sql_script.ProgressMeter(
+        "Splitting " + os.path.basename(dump_file),
+        os.path.getsize(dump_file)
+    )
+    try:
+        with sql_script.ScriptReader(dump_file, progress=progress) as script:
+            for statement in sql_script.split_statements(script):
+                text = statement.text
+                if _DEFERRED_STATEMENT.match(text[:500]):
+                    deferred.write(text + "\n;;\n")
+                    continue
+                match = _TABLE_STATEMENT.match(text)
+                if match:
+                    table = match.group(1)
+                    if table != current_table:
+                        if out:
+                            out.close()
+                        if table not in paths:
+                            paths[table] = os.path.join(
+                                split.directory, table + ".sql"
+                            )
+                        out = open(paths[table], 'ab')
+                        current_table = table
+                elif current_table is None:
+                    preamble.write(text + ";\n")
+                    continue
+                elif _USE_STATEMENT.match(text):
+                    raise ValueError(
+                        "Dumps of more than one database can't be restored "
+                        "in parallel. Use the sqlscript action instead."
+                    )
+                # UNLOCK TABLES and SET statements stay with their table
+                out.write(text + ";\n")
+    except:
+        split.cleanup()
+        raise
+    finally:
+        if out:
+            out.close()
+        preamble.close()
+        deferred.close()
+
+    tables = [
+        (name, path, os.path.getsize(path))
+        for name, path in paths.items()
+    ]
+    tables.sort(key=lambda item: (item[0] not in PRIORITY_TABLES, -item[2]))
+    split.tables = tables
+    return split
+
+
+def _restore_table(task):
+    """Load one table script on a new connection.
+
+    Runs in a worker process, so it takes and returns plain tuples.
+    """
+    connection_args, split_preamble, table, path = task
+    start = time.time()
+    try:
+        dbconn = Database(*connection_args)
+        if not dbconn.execute_sql_file(split_preamble):
+            return (table, False, 0, time.time() - start, "Preamble failed")
+        result = dbconn.execute_sql_file(path)
+        dbconn.close()
+    except Exception as ex:
+        return (table, False, 0, time.time() - start, str(ex))
+    return (
+        table,
+        result.success,
+        result.rowcount,
+        time.time() - start,
+        str(result.error) if result.error else None
+    )
+
+
+def restore_dump(settings, dump_file, database=None, workers=None):
+    """Restore a mysqldump file with one connection per worker.
+
+    Args:
+        settings (dictionary): The d2w settings.
+        dump_file (string): Path to the dump file.
+        database (string): The database to restore into.
+        workers (integer): Number of tables to load at the same time.
+
+    Returns:
+        True if every table and deferred statement was restored.
+    """
+    if not database:
+        database = settings['database']['drupal_database']
+    if not workers:
+        workers = (settings.get('d2w') or {}).get(
+            'restore_workers',
+            DEFAULT_WORKERS
+        )
+    workers = int(workers)
+    connection_args = (
+        settings['database']['drupal_host'],
+        settings['database']['drupal_username'],
+        settings['database']['drupal_password'],
+        database
+    )
+    project_path = (settings.get('project') or {}).get('default_project_path')
+
+    logger.info("Splitting %s by table...", dump_file)
+    split = split_dump(dump_file, project_path or None)
+    success = True
+    try:
+        logger.info(
+            "Restoring %s tables into %s with %s workers",
+            len(split.tables),
+            database,
+            workers
+        )
+        tasks = [
+            (connection_args, split.preamble, table, path)
+            for table, path, size in split.tables
+        ]
+        pool = multiprocessing.Pool(workers)
+        try:
+            for table, ok, rows, elapsed, error in pool.imap_unordered(
+                    _restore_table, tasks):
+                if ok:
+                    logger.info(
+                        "...%s: %s rows in %.1fs", table, rows, elapsed
+                    )
+                else:
+                    success = False
+                    logger.error("...%s failed: %s", table, error)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        if success and os.path.getsize(split.deferred) > len("DELIMITER ;;\n"):
+            logger.info("Restoring views, triggers and routines...")
+            dbconn = Database(*connection_args)
+            success = bool(dbconn.execute_sql_file(split.deferred))
+            dbconn.close()
+    except OperationalError:
+        logger.error("Could not access the database. Aborting restore.")
+        success = False
+    finally:
+        split.cleanup()
+    return success
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Compact rows for large query results.
+
+A DictCursor row is a dictionary holding its own copy of every column
+name, which costs several times the memory of the values themselves on
+multi-million row reads. A compact row is a tuple with no instance
+dictionary. Its class is generated once per result shape and maps
+column names to positions, so rows can still be read by name:
+
+    row["name"], row.get("src"), row.keys()
+
+They can also be unpacked and indexed like any tuple.
+"""
+
+_row_classes = {}
+
+
+def _getitem(self, key):
+    if isinstance(key, basestring):
+        try:
+            key = self._index[key]
+        except KeyError:
+            raise KeyError(key)
+    return tuple.__getitem__(self, key)
+
+
+def _get(self, key, default=None):
+    """Get the value of a column, or default if there is no such column."""
+    index = self._index.get(key)
+    if index is None:
+        return default
+    return tuple.__getitem__(self, index)
+
+
+def _keys(self):
+    """Get the column names."""
+    return list(self._fields)
+
+
+def _items(self):
+    """Get (column name, value) pairs."""
+    return zip(self._fields, self)
+
+
+def _asdict(self):
+    """Convert the row to a dictionary."""
+    return dict(zip(self._fields, self))
+
+
+def _repr(self):
+    return "Row({})".format(", ".join(
+        "{}={!r}".format(name, value) for name, value in zip(self._fields, self)
+    ))
+
+
+def row_class(columns):
+    """Get the row class for a result shape.
+
+    Args:
+        columns (sequence): The column names, in result order.
+
+    Returns:
+        type: A tuple subclass with dictionary style access by name.
+    """
+    columns = tuple(columns)
+    cls = _row_classes.get(columns)
+    if cls is None:
+        cls = type("Row", (tuple,), {
+            '__slots__': (),
+            '_fields': columns,
+            '_index': dict((name, index) for index, name in enumerate(columns)),
+            '__getitem__': _getitem,
+            'get': _get,
+            'keys': _keys,
+            'items': _items,
+            '_asdict': _asdict,
+            '__repr__': _repr,
+        })
+        _row_classes[columns] = cls
+    return cls
+
+
+def cursor_row_class(cur):
+    """Get the row class for the result of an executed cursor.
+
+    Args:
+        cur: A MySQLdb cursor that returns tuples.
+
+    Returns:
+        type: See row_class(), or None if the statement returned no result.
+    """
+    if not cur.description:
+        return None
+    return row_class(column[0] for column in cur.description)
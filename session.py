@@ -0,0 +1,220 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Share a bounded pool of database connections across a run.
+
+A Session opens one primary Database connection for an action and hands
+it to every step: prepare, the prerequisite checks, migrate and deploy.
+Helper connections for parallel work, such as the diagnostics queries
+or index rebuilds, are taken from the same pool with Database.clone()
+and go back to it with Database.close(), so they are reused rather than
+opened for each step. Idle connections are pinged before they are handed
+out and replaced if they have gone away.
+
+Closing the session closes every connection it opened.
+"""
+
+import logging
+import threading
+from contextlib import contextmanager
+from MySQLdb import OperationalError
+
+logger = logging.getLogger(__name__)
+
+# Connections per pool, the primary connection included
+DEFAULT_POOL_SIZE = 4
+
+
+class PoolExhausted(OperationalError):
+    """Raised when no connection is free and the pool is at its limit."""
+
+
+class ConnectionPool(object):
+    """A bounded pool of Database connections to one database.
+
+    Attributes:
+        size (integer): Maximum number of open connections.
+        created (integer): Connections opened over the pool's life.
+    """
+
+    def __init__(self, factory, size=DEFAULT_POOL_SIZE):
+        """Create an empty pool.
+
+        Args:
+            factory: A function that opens a new Database.
+            size (integer): Maximum number of open connections.
+        """
+        self._factory = factory
+        self.size = max(int(size), 1)
+        self.created = 0
+        self._idle = []
+        self._open = 0
+        self._closed = False
+        self._lock = threading.Condition()
+
+    def _connect(self):
+        dbconn = self._factory()
+        dbconn._pool = self
+        self.created += 1
+        return dbconn
+
+    def _discard(self, dbconn):
+        """Close a connection for good."""
+        dbconn._pool = None
+        try:
+            dbconn.close()
+        except Exception as ex:
+            logger.debug("Error while closing a connection: %s", ex)
+
+    def acquire(self, block=True, timeout=None):
+        """Take a healthy connection from the pool.
+
+        Args:
+            block (boolean): Wait for a connection to be released if the
+                pool is at its limit.
+            timeout (float): Seconds to wait, or None to wait forever.
+
+        Returns:
+            Database: A connection to hand back with release().
+
+        Raises:
+            PoolExhausted: No connection became free.
+        """
+        with self._lock:
+            if self._closed:
+                raise PoolExhausted(0, "The connection pool is closed")
+            while not self._idle and self._open >= self.size:
+                if not block:
+                    raise PoolExhausted(
+                        0,
+                        "All {} pooled connections are in use".format(self.size)
+                    )
+                self._lock.wait(timeout)
+                if timeout is not None and not self._idle and self._open >= self.size:
+                    raise PoolExhausted(
+                        0,
+                        "Timed out waiting for a pooled connection"
+                    )
+            if self._idle:
+                dbconn = self._idle.pop()
+            else:
+                dbconn = None
+            # Reserve the slot before connecting outside the lock
+            if dbconn is None:
+                self._open += 1
+
+        if dbconn is not None:
+            if dbconn.ping():
+                return dbconn
+            logger.info("Replacing a pooled connection that went away")
+            self._discard(dbconn)
+        try:
+            return self._connect()
+        except Exception:
+            with self._lock:
+                self._open -= 1
+                self._lock.notify()
+            raise
+
+    def release(self, dbconn, reuse=True):
+        """Hand a connection back to the pool.
+
+        Any transaction left open is rolled back. Connections that fail
+        their rollback, or are released after the pool was closed, are
+        closed instead.
+
+        Args:
+            dbconn (Database): A connection from acquire().
+            reuse (boolean): False closes the connection instead, e.g.
+                because its session state was changed.
+        """
+        healthy = reuse
+        if healthy:
+            try:
+                dbconn.rollback()
+            except Exception:
+                healthy = False
+        with self._lock:
+            if healthy and not self._closed:
+                self._idle.append(dbconn)
+                self._lock.notify()
+                return
+            self._open -= 1
+            self._lock.notify()
+        self._discard(dbconn)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a with block."""
+        dbconn = self.acquire()
+        try:
+            yield dbconn
+        finally:
+            self.release(dbconn)
+
+    def close(self):
+        """Close the idle connections and any released later."""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._lock.notify_all()
+        for dbconn in idle:
+            self._discard(dbconn)
+        logger.debug("Closed connection pool after %s connections", self.created)
+
+
+class Session(object):
+    """The connections used by one action on the Drupal database.
+
+    Use it as a context manager so the connections are closed at the
+    end of the action:
+
+        with Session(settings, Database) as session:
+            migrate.run_migration(settings, session.dbconn)
+
+    Attributes:
+        database (string): The database the connections use.
+        pool (ConnectionPool): The pool the connections come from.
+        dbconn (Database): The primary connection.
+    """
+
+    def __init__(self, settings, database_class, database=None):
+        """Open the primary connection.
+
+        Args:
+            settings (dictionary): The settings; the drupal_* database
+                settings and d2w.pool_size are used.
+            database_class: The Database class of the Drupal version.
+            database (string): The database to use. Defaults to
+                drupal_database.
+
+        Raises:
+            KeyError: The settings are missing database information.
+            OperationalError: The database could not be reached.
+        """
+        connection = settings['database']
+        self.database = database or connection['drupal_database']
+        size = (settings.get('d2w') or {}).get('pool_size', DEFAULT_POOL_SIZE)
+        self.pool = ConnectionPool(
+            lambda: database_class(
+                connection['drupal_host'],
+                connection['drupal_username'],
+                connection['drupal_password'],
+                self.database
+            ),
+            size
+        )
+        self.dbconn = self.pool.acquire()
+
+    def close(self):
+        """Close every connection of the session."""
+        if self.dbconn is not None:
+            self.pool.release(self.dbconn)
+            self.dbconn = None
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -30,6 +30,21 @@
  *******************************************************************************/
 
 
+/********************
+ * Stages
+ *
+ * Lines starting with "-- @stage" divide the script into stages. When
+ * migration_workers is set above 1 in settings.yml, stages that don't
+ * touch the same tables run at the same time on separate connections.
+ * The statements before the first stage always run first.
+ *
+ * A "-- @chunk" line runs the next statement in ranges of a key, e.g.
+ *   -- @chunk table=node key=nid column=n.nid size=10000 pause=0.5
+ * runs it for 10000 node ids at a time, restricted on n.nid, and
+ * commits after each range. pause= waits between ranges to keep the
+ * server responsive.
+ */
+
 /********************
  * Clear out WP tables and working tables.
  *
@@ -133,6 +148,7 @@ UPDATE drupaldb.term_data SET vid=2 WHERE vid=38;
  * Create a working table for the tags.
  *
  */
+-- @stage tags
 CREATE TABLE acc_tags AS
 	SELECT 
 		tid,
@@ -199,6 +215,7 @@ REPLACE INTO acc_wp_term_taxonomy (
  *
  * This is the working table for categories
  */
+-- @stage categories
 CREATE TABLE acc_categories AS
 	SELECT 
 		tid,
@@ -350,6 +367,7 @@ UPDATE wordpressdb.wp_term_taxonomy SET term_id=7517 WHERE term_taxonomy_id=7517
  * during an earlier query. Re-insert it if you want an 
  * Uncategorized category.
  */
+-- @stage uncategorized
 INSERT INTO acc_wp_terms (name, slug, term_group)
 	VALUES ('Uncategorized', 'uncategorized', 0);
 INSERT INTO acc_wp_term_taxonomy (		
@@ -372,7 +390,12 @@ INSERT INTO acc_wp_term_taxonomy (
 
 /********************
  * Create WP Posts from Drupal nodes
+ *
+ * acc_node_alias is built by the prepare stage. It maps each nid to its
+ * URL alias and the post name derived from it.
  */
+-- @stage posts
+-- @chunk table=node key=nid column=n.nid
 REPLACE INTO acc_wp_posts (
 		id,
 		post_author,
@@ -394,7 +417,7 @@ REPLACE INTO acc_wp_posts (
 		r.body 'post_content',
 		n.title 'post_title',
 		r.teaser 'post_excerpt',
-		IF(a.dst IS NULL,n.nid, SUBSTRING_INDEX(a.dst, '/', -1)) 'post_name',
+		IF(a.post_name IS NULL,n.nid, a.post_name) 'post_name',
 		DATE_ADD(FROM_UNIXTIME(0), interval n.changed second) 'post_modified',
 		n.type 'post_type',
 		IF(n.status = 1, 'publish', 'private') 'post_status',
@@ -403,8 +426,8 @@ REPLACE INTO acc_wp_posts (
 		' '
 	FROM node n
 	INNER JOIN node_revisions r USING(vid)
-	LEFT OUTER JOIN url_alias a
-		ON a.src = CONCAT('node/', n.nid)
+	LEFT OUTER JOIN acc_node_alias a
+		ON a.nid = n.nid
 		WHERE n.type IN (
             'page',
             'story');
@@ -463,16 +486,13 @@ UPDATE acc_wp_posts SET post_type = 'page' WHERE post_type NOT IN ('post');
  */
 
 /* Associate posts with terms */
+-- @stage term_relationships
 INSERT INTO acc_wp_term_relationships (
 	object_id,
 	term_taxonomy_id) 
 	SELECT DISTINCT nid, tid FROM term_node;
  
-/* Update tag counts */
-UPDATE acc_wp_term_taxonomy tt 
-	SET count = ( SELECT COUNT(tr.object_id)
-	FROM acc_wp_term_relationships tr
-	WHERE tr.term_taxonomy_id = tt.term_taxonomy_id);
+/* Tag counts are updated by the recount stage after this script */
 
 /* Fix taxonomy
  * Found in room34.com queries: Fix taxonomy
@@ -490,6 +510,7 @@ UPDATE IGNORE acc_wp_term_relationships, acc_wp_term_taxonomy
  * Manually look in the database for the term_id of the category you want to set as
  * the default category.
  */
+-- @stage default_category
 UPDATE acc_wp_options SET option_value='159' WHERE option_name='default_category';
 UPDATE acc_wp_term_taxonomy SET taxonomy='category' WHERE term_id=159;/* Unclassified term */
 
@@ -518,6 +539,7 @@ WHERE post_name LIKE '%“%';
 /********************
  * Migrate comments
  */
+-- @stage comments
 REPLACE INTO acc_wp_comments (
 	comment_ID,
 	comment_post_ID,
@@ -539,11 +561,7 @@ REPLACE INTO acc_wp_comments (
 		SUBSTRING(homepage,1,200),
 		((status + 1) % 2) FROM comments;
 
-/* Update comment counts */
-UPDATE acc_wp_posts
-	SET comment_count = ( SELECT COUNT(comment_post_id) 
-	FROM acc_wp_comments
-	WHERE acc_wp_posts.id = acc_wp_comments.comment_post_id);
+/* Comment counts are updated by the recount stage after this script */
 
 /********************
  * Migrate Drupal Authors into WordPress
@@ -557,6 +575,7 @@ UPDATE acc_wp_posts
  */
 
 /* Delete all WP Authors except for admin */
+-- @stage authors
 DELETE FROM acc_wp_users WHERE ID > 1;
 DELETE FROM acc_wp_usermeta WHERE user_id > 1;
 
@@ -643,6 +662,8 @@ UPDATE acc_wp_posts
  */
 
 /* Update filepath */
+-- @stage site_options
+-- @chunk table=acc_wp_posts key=ID
 UPDATE acc_wp_posts SET post_content = REPLACE(post_content, '"/files/', '"/wp-content/uploads/');
 
 /* Set site name */
@@ -670,17 +691,17 @@ DROP TABLE IF EXISTS acc_redirects;
 CREATE TABLE acc_redirects AS
 	SELECT
 		CONCAT('site_name/', 
-			IF(a.dst IS NULL,
+			IF(a.alias IS NULL,
 				CONCAT('node/', n.nid), 
-				a.dst
+				a.alias
 			)
 		) 'old_url',
-		IF(a.dst IS NULL,n.nid, SUBSTRING_INDEX(a.dst, '/', -1)) 'new_url',
+		IF(a.post_name IS NULL,n.nid, a.post_name) 'new_url',
 		'301' redirect_code
 	FROM node n
 	INNER JOIN node_revisions r USING(vid)
-	LEFT OUTER JOIN url_alias a
-		ON a.src = CONCAT('node/', n.nid)
+	LEFT OUTER JOIN acc_node_alias a
+		ON a.nid = n.nid
 		WHERE n.type IN (
         		* List the post types we migrated earlier *
         			'page',
@@ -708,6 +729,7 @@ CREATE TABLE acc_redirects AS
 *
 */
 
+-- @stage commenters
 CREATE TABLE acc_users_with_comments LIKE acc_wp_users;
 CREATE TABLE acc_users_add_commenters LIKE acc_wp_users;
 CREATE TABLE acc_wp_users LIKE acc_wp_users;
@@ -0,0 +1,1326 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Split and execute MySQL script files.
+
+This module replaces piping script files through the mysql command line
+client. Scripts are streamed in fixed-size chunks, split into statements
+the same way the mysql client does it and executed on an open MySQLdb
+connection, so memory use doesn't grow with the size of the script.
+Dumps compressed with gzip or xz are decompressed on the fly.
+"""
+
+import os
+import re
+import json
+import time
+import gzip
+import mmap
+import heapq
+import hashlib
+import logging
+from datetime import timedelta
+import MySQLdb as mdb
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        # Only needed to read .xz dumps
+        lzma = None
+
+logger = logging.getLogger(__name__)
+
+# Errors raised while reading a missing, unreadable or corrupt script
+READ_ERRORS = (IOError, OSError)
+if lzma is not None:
+    READ_ERRORS += (lzma.LZMAError,)
+
+DEFAULT_DELIMITER = ";"
+DEFAULT_CHUNK_SIZE = 1048576 #1MB
+# Keys per transaction for statements run in chunks
+DEFAULT_CHUNK_ROWS = 10000
+# Session settings for loading tables that are rebuilt from scratch.
+# sql_log_bin needs the SUPER privilege and is skipped without it.
+BULK_LOAD_SETTINGS = (
+    ('unique_checks', 0),
+    ('foreign_key_checks', 0),
+    ('sql_log_bin', 0),
+    ('sort_buffer_size', 67108864), #64MB
+    ('join_buffer_size', 8388608), #8MB
+    ('bulk_insert_buffer_size', 268435456), #256MB
+)
+# Statements per transaction while bulk loading
+DEFAULT_COMMIT_EVERY = 100
+# Seconds between progress reports
+PROGRESS_INTERVAL = 10
+# Characters of a statement kept in its result
+SNIPPET_LENGTH = 200
+
+# The mysql client only recognises DELIMITER at the start of a statement
+_DELIMITER_COMMAND = re.compile(r"\s*delimiter\s+(\S+)", re.IGNORECASE)
+# Statements that change session state and are replayed when resuming
+_SESSION_STATEMENT = re.compile(r"^(?:/\*!\d+\s*)?(?:SET|USE)\s", re.IGNORECASE)
+# Temporary tables only last for the session, so they can't be skipped
+_CREATE_TEMPORARY = re.compile(
+    r"^(?:/\*!\d+\s*)?CREATE\s+TEMPORARY\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?"
+    r"([`\w.]+)",
+    re.IGNORECASE
+)
+_DROP_TABLES = re.compile(
+    r"^(?:/\*!\d+\s*)?DROP\s+(?:TEMPORARY\s+)?TABLES?\s+(?:IF\s+EXISTS\s+)?"
+    r"([`\w.,\s]+)",
+    re.IGNORECASE
+)
+# Statements that commit the open transaction implicitly
+_IMPLICIT_COMMIT = re.compile(
+    r"^(?:/\*!\d+\s*)?(?:ALTER|CREATE|DROP|RENAME|TRUNCATE|LOCK|UNLOCK|GRANT"
+    r"|REVOKE|ANALYZE|OPTIMIZE|REPAIR|FLUSH|BEGIN|START|COMMIT)\b",
+    re.IGNORECASE
+)
+_WRITE_STATEMENT = re.compile(
+    r"^(?:/\*!\d+\s*)?(?:INSERT|REPLACE|UPDATE|DELETE|LOAD)\b",
+    re.IGNORECASE
+)
+# The written tables of a write statement are named before these
+_WRITE_HEAD_END = re.compile(r"\b(?:VALUES?|SELECT|WHERE)\b", re.IGNORECASE)
+_NAME = re.compile(r"\w+")
+# Engines whose changes are undone by a rollback
+TRANSACTIONAL_ENGINES = ('InnoDB', 'ndbcluster', 'TokuDB', 'RocksDB')
+# Characters that end a quoted string or escape the next character
+_STRING_END = {
+    "'": re.compile(r"[\\']"),
+    '"': re.compile(r'[\\"]'),
+    "`": re.compile(r"`"),
+}
+# Strings, quoted names and comments, which can't hold SQL keywords
+_IGNORED_TEXT = re.compile(
+    r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"|`[^`]*`"
+    r"|/\*.*?\*/|(?:--\s|#)[^\n]*",
+    re.DOTALL
+)
+_WORD_OR_BRACKET = re.compile(r"\w+|[()]")
+# Clauses that end the WHERE clause of a statement
+_CLAUSES_AFTER_WHERE = set([
+    'GROUP', 'HAVING', 'ORDER', 'LIMIT', 'UNION', 'FOR', 'LOCK', 'WINDOW',
+    'INTO'
+])
+
+
+class Directive(object):
+    """An instruction to the script runner written as a comment.
+
+    Directives are comment lines starting with "-- @", for example
+    "-- @stage posts writes=acc_wp_posts". They apply to the statement
+    that follows them.
+
+    Attributes:
+        name (string): The directive name, e.g. "stage".
+        args (list): Positional arguments.
+        options (dictionary): key=value arguments.
+    """
+    __slots__ = ('name', 'args', 'options')
+
+    def __init__(self, name, args=None, options=None):
+        self.name = name
+        self.args = args or []
+        self.options = options or {}
+
+    @classmethod
+    def parse(cls, comment):
+        """Parse the text of a comment after the "@"."""
+        words = comment.split()
+        directive = cls(words[0].lower())
+        for word in words[1:]:
+            if "=" in word:
+                key, value = word.split("=", 1)
+                directive.options[key.lower()] = value
+            else:
+                directive.args.append(word)
+        return directive
+
+    def get_list(self, key):
+        """Get a comma separated option as a list."""
+        value = self.options.get(key)
+        if not value:
+            return []
+        return [item for item in value.split(",") if item]
+
+
+class Statement(object):
+    """A single statement read from a script file.
+
+    Attributes:
+        index (integer): Position of the statement in the script, from 1.
+        text (string): The statement without its delimiter.
+        first_line (integer): Line where the statement starts.
+        last_line (integer): Line where the statement ends.
+        directives (list): Directives written just before the statement.
+    """
+    __slots__ = ('index', 'text', 'first_line', 'last_line', 'directives')
+
+    def __init__(self, index, text, first_line, last_line, directives=None):
+        self.index = index
+        self.text = text
+        self.first_line = first_line
+        self.last_line = last_line
+        self.directives = directives or []
+
+    def get_directive(self, name):
+        """Get the directive with the given name or None."""
+        for directive in self.directives:
+            if directive.name == name:
+                return directive
+        return None
+
+    def summary(self, length=60):
+        """Get the start of the statement on a single line."""
+        text = " ".join(self.text.split())
+        if len(text) > length:
+            text = text[:length - 3] + "..."
+        return text
+
+
+class StatementResult(object):
+    """The outcome of executing a single statement.
+
+    Only the position and the start of the statement are kept, so the
+    results of huge statements don't hold on to their text.
+
+    Attributes:
+        index (integer): Position of the statement in the script.
+        first_line (integer): Line where the statement starts.
+        last_line (integer): Line where the statement ends.
+        snippet (string): The start of the statement on a single line.
+        rowcount (long): Rows affected or returned by the statement.
+        elapsed (float): Wall time in seconds.
+        warnings (integer): Number of warnings raised by the server.
+        warning (string): The first warning message, if any.
+    """
+    __slots__ = ('index', 'first_line', 'last_line', 'snippet', 'rowcount',
+                 'elapsed', 'warnings', 'warning')
+
+    def __init__(self, statement, rowcount, elapsed, warnings=0, warning=None):
+        self.index = statement.index
+        self.first_line = statement.first_line
+        self.last_line = statement.last_line
+        self.snippet = statement.summary(SNIPPET_LENGTH)
+        self.rowcount = rowcount
+        self.elapsed = elapsed
+        self.warnings = warnings
+        self.warning = warning
+
+    def summary(self, length=60):
+        """Get the start of the statement, shortened to length."""
+        if len(self.snippet) > length:
+            return self.snippet[:length - 3] + "..."
+        return self.snippet
+
+
+class ScriptResult(object):
+    """The outcome of executing a script file.
+
+    Evaluates to True if every statement was executed so callers
+    expecting the old boolean result keep working. Only running totals
+    are kept, so memory use doesn't grow with the size of the script,
+    unless the script is profiled.
+
+    Attributes:
+        filename (string): The script that was executed.
+        executed (integer): Number of statements executed.
+        rowcount (long): Rows affected or returned by the statements.
+        elapsed (float): Time spent executing the statements in seconds.
+        warnings (integer): Number of warnings raised by the server.
+        error: The exception that stopped the script or None.
+        failed_statement (Statement): The statement that raised the error.
+        skipped (integer): Statements skipped when resuming the script.
+        statements (list): A StatementResult for each executed statement
+            when profiling, otherwise None.
+    """
+
+    def __init__(self, filename, profile=False):
+        self.filename = filename
+        self.executed = 0
+        self.rowcount = 0
+        self.elapsed = 0.0
+        self.warnings = 0
+        self.error = None
+        self.failed_statement = None
+        self.skipped = 0
+        self.statements = [] if profile else None
+
+    @property
+    def success(self):
+        return self.error is None
+
+    def add(self, statement_result):
+        """Count an executed statement."""
+        self.executed += 1
+        self.rowcount += statement_result.rowcount
+        self.elapsed += statement_result.elapsed
+        self.warnings += statement_result.warnings
+        if self.statements is not None:
+            self.statements.append(statement_result)
+
+    def merge(self, other):
+        """Add the counts of another result, e.g. of a stage."""
+        self.executed += other.executed
+        self.rowcount += other.rowcount
+        self.elapsed += other.elapsed
+        self.warnings += other.warnings
+        self.skipped += other.skipped
+        if self.statements is not None and other.statements:
+            self.statements.extend(other.statements)
+
+    def __nonzero__(self):
+        return self.success
+
+    __bool__ = __nonzero__
+
+
+class ScriptProfile(object):
+    """Collect statement timings across several script runs.
+
+    Attributes:
+        scripts (list): The ScriptResult of each script, in run order.
+    """
+
+    def __init__(self):
+        self.scripts = []
+
+    def add(self, result):
+        self.scripts.append(result)
+
+    @property
+    def elapsed(self):
+        return sum(script.elapsed for script in self.scripts)
+
+    def slowest(self, limit=10):
+        """Get the slowest statements across all scripts.
+
+        Returns:
+            list: (ScriptResult, StatementResult) tuples, slowest first.
+        """
+        return heapq.nlargest(
+            limit,
+            (
+                (script, result)
+                for script in self.scripts
+                for result in script.statements or []
+            ),
+            key=lambda item: item[1].elapsed
+        )
+
+    def to_dict(self):
+        return {
+            "elapsed": self.elapsed,
+            "scripts": [
+                {
+                    "filename": script.filename,
+                    "success": script.success,
+                    "error": str(script.error) if script.error else None,
+                    "elapsed": script.elapsed,
+                    "executed": script.executed,
+                    "rowcount": script.rowcount,
+                    "warnings": script.warnings,
+                    "skipped": script.skipped,
+                    "statements": [
+                        {
+                            "index": result.index,
+                            "first_line": result.first_line,
+                            "last_line": result.last_line,
+                            "elapsed": result.elapsed,
+                            "rowcount": result.rowcount,
+                            "warnings": result.warnings,
+                            "warning": result.warning,
+                            "statement": result.snippet,
+                        }
+                        for result in script.statements or []
+                    ]
+                }
+                for script in self.scripts
+            ]
+        }
+
+    def write_json(self, filename):
+        """Write the profile to a JSON file."""
+        with open(filename, 'w') as profile_file:
+            json.dump(self.to_dict(), profile_file, indent=2)
+
+
+class ScriptJournal(object):
+    """Record which statements of a script have completed.
+
+    The journal is a table in the working database keyed by the path of
+    the script, so it is reset along with the database. Each entry holds
+    a hash of the statement, and a statement edited since it completed
+    runs again. A script that failed can be fixed and resumed without
+    losing the progress recorded for the statements before the fix.
+    """
+    TABLE = "acc_statement_journal"
+
+    def __init__(self, connection, database, script):
+        self._connection = connection
+        self._table = "`{}`.{}".format(database, self.TABLE)
+        self.script = script
+        self.script_key = statement_hash(os.path.abspath(script))
+        self._completed = {}
+
+    def _execute(self, query, params=None):
+        cur = self._connection.cursor()
+        try:
+            try:
+                cur.execute(query, params)
+            except mdb.Warning:
+                # e.g. the journal table already exists
+                pass
+            return cur.fetchall()
+        finally:
+            cur.close()
+
+    def load(self):
+        """Load the completed statements.
+
+        Returns:
+            dictionary: The statement hash for each completed index.
+        """
+        self._execute(
+            "CREATE TABLE IF NOT EXISTS " + self._table + " ("
+            "script_key CHAR(40) NOT NULL, "
+            "statement_index INT UNSIGNED NOT NULL, "
+            "statement_hash CHAR(40) NOT NULL, "
+            "completed_at DATETIME NOT NULL, "
+            "PRIMARY KEY (script_key, statement_index)"
+            ") ENGINE=INNODB"
+        )
+        rows = self._execute(
+            "SELECT statement_index, statement_hash FROM " + self._table +
+            " WHERE script_key = %s",
+            (self.script_key,)
+        )
+        self._completed = dict((row[0], row[1]) for row in rows)
+        return self._completed
+
+    def is_completed(self, statement):
+        """Check if a statement completed in an earlier run.
+
+        A statement that was edited since then counts as not completed.
+        """
+        recorded = self._completed.get(statement.index)
+        if recorded is None:
+            return False
+        if recorded != statement_hash(statement.text):
+            logger.info(
+                "Statement %s of %s changed since it completed and will run again",
+                statement.index,
+                self.script
+            )
+            return False
+        return True
+
+    def for_connection(self, connection):
+        """Get a journal for the same script on another connection."""
+        journal = ScriptJournal.__new__(ScriptJournal)
+        journal._connection = connection
+        journal._table = self._table
+        journal.script = self.script
+        journal.script_key = self.script_key
+        journal._completed = self._completed
+        return journal
+
+    def mark(self, statement):
+        """Record a completed statement."""
+        self._execute(
+            "REPLACE INTO " + self._table +
+            " (script_key, statement_index, statement_hash, completed_at) "
+            "VALUES (%s, %s, %s, NOW())",
+            (self.script_key, statement.index, statement_hash(statement.text))
+        )
+
+    def clear(self):
+        """Forget the progress of the script."""
+        self._execute(
+            "DELETE FROM " + self._table + " WHERE script_key = %s",
+            (self.script_key,)
+        )
+        self._completed = {}
+
+
+class CommitPoints(object):
+    """Spot statements whose changes a rollback can't undo.
+
+    DDL and other statements that commit implicitly, chunked statements
+    and writes to non-transactional tables such as MyISAM take effect
+    at once. When statements are committed in batches, the batch and
+    its journal entries must be committed right after them, or a
+    rollback would lose the record of changes that were kept.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._tables = None
+
+    def _non_transactional_tables(self):
+        if self._tables is None:
+            cur = self._connection.cursor()
+            try:
+                cur.execute(
+                    "SELECT LOWER(table_name) FROM information_schema.tables "
+                    "WHERE table_schema = DATABASE() "
+                    "AND table_type = 'BASE TABLE' "
+                    "AND engine NOT IN (" +
+                    ", ".join(["%s"] * len(TRANSACTIONAL_ENGINES)) + ")",
+                    TRANSACTIONAL_ENGINES
+                )
+                self._tables = set(row[0] for row in cur.fetchall())
+            finally:
+                cur.close()
+        return self._tables
+
+    def check(self, statement):
+        """Check if a statement just committed or can't be rolled back."""
+        text = statement.text
+        if _IMPLICIT_COMMIT.match(text) or statement.get_directive('chunk'):
+            # Tables may have been created or changed engine
+            self._tables = None
+            return True
+        if _SESSION_STATEMENT.match(text):
+            # USE switches the database
+            self._tables = None
+            return False
+        if not _WRITE_STATEMENT.match(text):
+            return False
+        tables = self._non_transactional_tables()
+        if not tables:
+            return False
+        end = _WRITE_HEAD_END.search(text)
+        head = text[:end.start()] if end else text
+        return any(name.lower() in tables for name in _NAME.findall(head))
+
+
+class StatementBatch(object):
+    """Commit the statements run on a connection in batches.
+
+    Without commit_every each statement is committed as it runs, like
+    the mysql client. Otherwise the statements and their journal entries
+    are committed every commit_every statements and right after any
+    statement a rollback can't undo. See CommitPoints.
+
+    Attributes:
+        pending (integer): Statements run since the last commit.
+    """
+
+    def __init__(self, connection, commit_every=None, journal=None):
+        self.connection = connection
+        self.commit_every = commit_every
+        self.journal = journal
+        self.pending = 0
+        self._commit_points = None
+        if journal and commit_every:
+            self._commit_points = CommitPoints(connection)
+
+    def start(self):
+        self.connection.autocommit(not self.commit_every)
+        return self
+
+    def completed(self, statement):
+        """Record a statement that ran without error."""
+        if self.journal:
+            self.journal.mark(statement)
+        if self.commit_every:
+            self.pending += 1
+            if self.pending >= self.commit_every or (
+                    self._commit_points and
+                    self._commit_points.check(statement)):
+                self.commit()
+
+    def commit(self):
+        if self.pending:
+            self.connection.commit()
+            self.pending = 0
+
+    def rollback(self):
+        """Roll back the open batch after an error."""
+        if self.pending:
+            self.connection.rollback()
+            logger.warning(
+                "Rolled back the last %s statements before the error",
+                self.pending
+            )
+            self.pending = 0
+
+    def stop(self, autocommit=False):
+        """Set the connection's autocommit mode when the batch is done."""
+        self.connection.autocommit(autocommit)
+
+
+class BulkLoadSession(object):
+    """Switch a connection to bulk load settings and back again.
+
+    Unique and foreign key checks and binary logging are turned off and
+    the sort and join buffers are enlarged. Settings the user isn't
+    allowed to change are skipped. The applied settings are logged and
+    the previous values are restored by stop(). Use it as a context
+    manager or call start() and stop().
+
+    Attributes:
+        commit_every (integer): Statements per transaction for scripts
+            run during the session.
+        applied (dictionary): The previous value of each setting changed.
+    """
+
+    def __init__(self, connection, settings=BULK_LOAD_SETTINGS,
+                 commit_every=DEFAULT_COMMIT_EVERY):
+        self.connection = connection
+        self.settings = settings
+        self.commit_every = commit_every
+        self.applied = {}
+
+    def start(self):
+        self.applied = apply_session_settings(self.connection, self.settings)
+        logger.info(
+            "Bulk load session: %s, commit every %s statements",
+            _format_settings(self.settings, self.applied),
+            self.commit_every
+        )
+        return self
+
+    def stop(self):
+        restore = [
+            (name, self.applied[name])
+            for name, value in self.settings
+            if name in self.applied
+        ]
+        restored = apply_session_settings(self.connection, restore)
+        logger.info(
+            "Restored session settings: %s",
+            _format_settings(restore, restored)
+        )
+        self.applied = {}
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+class ProgressMeter(object):
+    """Log throughput and estimated time remaining while reading a file.
+
+    Progress is measured in bytes unless units are given, e.g. "rows".
+
+    Attributes:
+        total (long): Expected number of bytes or None if unknown.
+        done (long): Bytes read so far.
+    """
+
+    def __init__(self, label, total=None, interval=PROGRESS_INTERVAL,
+                 units=None):
+        self.label = label
+        self.total = total
+        self.units = units
+        self.done = 0
+        self._interval = interval
+        self._start = time.time()
+        self._last_report = self._start
+
+    def rate(self):
+        """Bytes per second since the meter started."""
+        elapsed = time.time() - self._start
+        if elapsed <= 0:
+            return 0.0
+        return self.done / elapsed
+
+    def eta(self):
+        """Estimated time remaining or None if it can't be estimated."""
+        rate = self.rate()
+        if not self.total or rate <= 0:
+            return None
+        remaining = max(self.total - self.done, 0)
+        return timedelta(seconds=int(remaining / rate))
+
+    def update(self, done):
+        """Record progress and log it if the report interval has passed."""
+        self.done = done
+        now = time.time()
+        if now - self._last_report >= self._interval:
+            self._last_report = now
+            self.report()
+
+    def _format(self, value):
+        if self.units:
+            return "{:,.0f} {}".format(value, self.units)
+        return format_bytes(value)
+
+    def report(self):
+        if self.total:
+            logger.info(
+                "%s: %s of %s (%.0f%%) at %s/s, ETA %s",
+                self.label,
+                self._format(self.done),
+                self._format(self.total),
+                100.0 * self.done / self.total,
+                self._format(self.rate()),
+                self.eta()
+            )
+        else:
+            logger.info(
+                "%s: %s at %s/s",
+                self.label,
+                self._format(self.done),
+                self._format(self.rate())
+            )
+
+
+class ScriptReader(object):
+    """Read the lines of a script file in fixed-size chunks.
+
+    Files ending in .gz or .xz are decompressed as they are read.
+    Uncompressed files can optionally be read through a memory map.
+    Progress is measured against the size of the file on disk.
+    """
+
+    def __init__(self, filename, chunk_size=DEFAULT_CHUNK_SIZE,
+                 use_mmap=False, progress=None):
+        self.filename = filename
+        self._chunk_size = chunk_size
+        self._progress = progress
+        self._raw = open(filename, 'rb')
+        self._map = None
+        self._map_pos = 0
+
+        if filename.endswith(".gz"):
+            self._stream = gzip.GzipFile(fileobj=self._raw, mode='rb')
+        elif filename.endswith(".xz"):
+            if lzma is None:
+                self._raw.close()
+                raise ImportError(
+                    "Reading .xz files requires the lzma module "
+                    "(pip install backports.lzma)"
+                )
+            self._stream = lzma.LZMAFile(self._raw)
+        else:
+            self._stream = self._raw
+            # mmap can't map an empty file
+            if use_mmap and os.path.getsize(filename) > 0:
+                self._map = mmap.mmap(
+                    self._raw.fileno(), 0, access=mmap.ACCESS_READ
+                )
+
+    def position(self):
+        """Bytes of the file on disk consumed so far."""
+        if self._map is not None:
+            return self._map_pos
+        return self._raw.tell()
+
+    def _read(self):
+        if self._map is not None:
+            chunk = self._map[self._map_pos:self._map_pos + self._chunk_size]
+            self._map_pos += len(chunk)
+            return chunk
+        return self._stream.read(self._chunk_size)
+
+    def __iter__(self):
+        pending = []
+        while True:
+            chunk = self._read()
+            if not chunk:
+                break
+            if self._progress:
+                self._progress.update(self.position())
+            lines = chunk.split("\n")
+            if len(lines) == 1:
+                # A line longer than the chunk size
+                pending.append(chunk)
+                continue
+            pending.append(lines[0])
+            yield "".join(pending) + "\n"
+            for line in lines[1:-1]:
+                yield line + "\n"
+            pending = [lines[-1]]
+        tail = "".join(pending)
+        if tail:
+            yield tail
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        if self._stream is not self._raw:
+            self._stream.close()
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def apply_session_settings(connection, settings):
+    """Set session variables, skipping any that can't be set.
+
+    Args:
+        connection: An open MySQLdb connection.
+        settings: (name, value) pairs of session variables.
+
+    Returns:
+        dictionary: The previous value of each variable that was set.
+    """
+    previous = {}
+    cur = connection.cursor()
+    try:
+        for name, value in settings:
+            try:
+                cur.execute("SELECT @@SESSION.{}".format(name))
+                old_value = cur.fetchone()[0]
+                cur.execute("SET SESSION {} = %s".format(name), (value,))
+            except (mdb.Error, mdb.Warning) as ex:
+                logger.warning("Could not set %s: %s", name, ex)
+            else:
+                previous[name] = old_value
+    finally:
+        cur.close()
+    return previous
+
+
+def _format_settings(settings, applied):
+    """List the settings that were applied for the log."""
+    return ", ".join(
+        "{}={}".format(name, value)
+        for name, value in settings
+        if name in applied
+    ) or "none"
+
+
+def statement_hash(text):
+    """Get the SHA-1 hex digest of a statement or other text."""
+    if isinstance(text, unicode):
+        text = text.encode('utf8')
+    return hashlib.sha1(text).hexdigest()
+
+
+def format_bytes(count):
+    """Format a number of bytes for display, e.g. 1.5 GB."""
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(count) < 1024.0:
+            return "{:.1f} {}".format(count, unit)
+        count /= 1024.0
+    return "{:.1f} TB".format(count)
+
+
+def split_statements(lines, delimiter=DEFAULT_DELIMITER):
+    """Split the lines of a script into statements.
+
+    Follows the rules of the mysql command line client: comments are
+    removed except for executable /*! ... */ comments, delimiters inside
+    quoted strings are ignored and DELIMITER commands change the
+    statement delimiter. Directive comments ("-- @name ...") are
+    attached to the statement that follows them.
+
+    Args:
+        lines: An iterable of lines, such as an open file.
+        delimiter (string): The initial statement delimiter.
+
+    Yields:
+        Statement: Each statement in the order it appears in the script.
+    """
+    index = 0
+    buf = []
+    directives = []
+    first_line = None
+    quote = None
+    # None outside comments, otherwise True if the comment is kept
+    block_comment = None
+    pattern = _statement_pattern(delimiter)
+
+    for line_number, line in enumerate(lines, 1):
+        pos = 0
+        end = len(line)
+
+        if quote is None and block_comment is None and first_line is None:
+            match = _DELIMITER_COMMAND.match(line)
+            if match:
+                delimiter = match.group(1)
+                pattern = _statement_pattern(delimiter)
+                continue
+
+        while pos < end:
+            if block_comment is not None:
+                close = line.find("*/", pos)
+                stop = end if close < 0 else close + 2
+                if block_comment:
+                    buf.append(line[pos:stop])
+                else:
+                    buf.append(" ")
+                if close >= 0:
+                    block_comment = None
+                pos = stop
+                continue
+
+            if quote is not None:
+                match = _STRING_END[quote].search(line, pos)
+                if not match:
+                    buf.append(line[pos:])
+                    pos = end
+                    continue
+                found = match.start()
+                if line[found] == "\\":
+                    buf.append(line[pos:found + 2])
+                    pos = found + 2
+                elif line.startswith(quote * 2, found):
+                    buf.append(line[pos:found + 2])
+                    pos = found + 2
+                else:
+                    buf.append(line[pos:found + 1])
+                    pos = found + 1
+                    quote = None
+                continue
+
+            match = pattern.search(line, pos)
+            if not match:
+                chunk = line[pos:]
+                if first_line is None and chunk.strip():
+                    first_line = line_number
+                buf.append(chunk)
+                pos = end
+                continue
+
+            found = match.start()
+            token = match.group()
+            if first_line is None and line[pos:found].strip():
+                first_line = line_number
+            buf.append(line[pos:found])
+
+            if token == delimiter:
+                text = "".join(buf).strip()
+                if text:
+                    index += 1
+                    yield Statement(
+                        index, text, first_line, line_number, directives
+                    )
+                    directives = []
+                buf = []
+                first_line = None
+                pos = found + len(token)
+            elif token in _STRING_END:
+                if first_line is None:
+                    first_line = line_number
+                buf.append(token)
+                quote = token
+                pos = found + 1
+            elif token == "/*":
+                if line[found + 2:found + 3] in ("!", "+"):
+                    if first_line is None:
+                        first_line = line_number
+                    block_comment = True
+                    buf.append(token)
+                else:
+                    block_comment = False
+                pos = found + 2
+            elif token == "--" and line[found + 2:found + 3] not in (
+                    "", " ", "\t", "\r", "\n"):
+                # Not a comment, e.g. "a--1"
+                buf.append(token)
+                pos = found + 2
+            else:
+                # Comment to the end of the line
+                comment = line[found + len(token):].strip()
+                if token == "--" and comment[:1] == "@" and len(comment) > 1:
+                    directives.append(Directive.parse(comment[1:]))
+                buf.append("\n")
+                pos = end
+
+    text = "".join(buf).strip()
+    if text:
+        index += 1
+        yield Statement(index, text, first_line, line_number, directives)
+
+
+def _statement_pattern(delimiter):
+    """Match the next token that the splitter needs to act on."""
+    return re.compile(r"""['"`#]|--|/\*|""" + re.escape(delimiter))
+
+
+def execute_statement(connection, statement):
+    """Execute a single statement on an open connection.
+
+    Server warnings are logged and counted but not raised. A statement
+    with a chunk directive, e.g.
+
+        -- @chunk table=node key=nid column=n.nid size=10000 pause=0.5
+
+    is run in ranges of the key with execute_chunked().
+
+    Args:
+        connection: An open MySQLdb connection.
+        statement (Statement): The statement to execute.
+
+    Returns:
+        StatementResult: Rows affected and timing of the statement.
+
+    Raises:
+        MySQLdb.Error: If the statement failed.
+        ValueError: If a chunk directive is incomplete or the statement
+            can't be run in chunks.
+    """
+    start = time.time()
+    chunk = statement.get_directive('chunk')
+    if chunk:
+        if not chunk.options.get('table') or not chunk.options.get('key'):
+            raise ValueError("The chunk directive needs table= and key=")
+        rowcount, warnings, warning = execute_chunked(
+            connection,
+            statement.text,
+            chunk.options['table'],
+            chunk.options['key'],
+            chunk.options.get('column'),
+            chunk.options.get('size', DEFAULT_CHUNK_ROWS),
+            chunk.options.get('pause', 0),
+            "Statement {}".format(statement.index)
+        )
+        return StatementResult(
+            statement,
+            rowcount,
+            time.time() - start,
+            warnings,
+            warning
+        )
+
+    warnings = 0
+    warning = None
+    cur = connection.cursor()
+    try:
+        try:
+            cur.execute(statement.text)
+            while cur.nextset():
+                pass
+        except mdb.Warning as warn:
+            warnings = connection.warning_count() or 1
+            warning = str(warn)
+            logger.warning(
+                "Warning at lines %s-%s: %s",
+                statement.first_line,
+                statement.last_line,
+                warn
+            )
+        else:
+            warnings = connection.warning_count()
+        rowcount = max(cur.rowcount, 0)
+    finally:
+        cur.close()
+    return StatementResult(
+        statement,
+        rowcount,
+        time.time() - start,
+        warnings,
+        warning
+    )
+
+
+def _blank(match):
+    return " " * len(match.group())
+
+
+def _top_level_words(text):
+    """Find the words of a statement outside brackets, strings and comments.
+
+    Returns:
+        list: (WORD, start, end) tuples in the order they appear.
+    """
+    blanked = _IGNORED_TEXT.sub(_blank, text)
+    words = []
+    depth = 0
+    for match in _WORD_OR_BRACKET.finditer(blanked):
+        token = match.group()
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+        elif depth == 0:
+            words.append((token.upper(), match.start(), match.end()))
+    return words
+
+
+def split_for_range(text, column):
+    """Find where a key range condition can be added to a statement.
+
+    The condition is ANDed with the top-level WHERE clause, or becomes
+    the WHERE clause if there is none. UPDATE, DELETE and INSERT or
+    REPLACE ... SELECT statements are supported.
+
+    Args:
+        text (string): The statement.
+        column (string): The column to restrict, e.g. "n.nid".
+
+    Returns:
+        tuple: (head, tail) so that head + condition + tail is the
+            statement restricted to the condition.
+
+    Raises:
+        ValueError: If the statement can't be restricted to a range.
+    """
+    words = _top_level_words(text)
+    verb = words[0][0] if words else None
+    if verb not in ('UPDATE', 'DELETE', 'INSERT', 'REPLACE'):
+        raise ValueError(
+            "Only UPDATE, DELETE, INSERT and REPLACE statements can be chunked"
+        )
+    if 'UNION' in [word for word, start, end in words]:
+        raise ValueError("Statements with UNION can't be chunked")
+    if verb in ('INSERT', 'REPLACE'):
+        selects = [i for i, word in enumerate(words) if word[0] == 'SELECT']
+        if not selects:
+            raise ValueError(
+                "Only INSERT ... SELECT statements can be chunked"
+            )
+        words = words[selects[0]:]
+
+    where = None
+    clause_end = len(text.rstrip())
+    for i, (word, start, end) in enumerate(words):
+        following = words[i + 1][0] if i + 1 < len(words) else None
+        if word == 'WHERE' and where is None:
+            where = end
+        elif word in _CLAUSES_AFTER_WHERE or (
+                word == 'ON' and following == 'DUPLICATE'):
+            clause_end = start
+            break
+
+    if where is None:
+        return (text[:clause_end].rstrip() + " WHERE ", " " + text[clause_end:])
+    return (
+        text[:where] + " ",
+        " AND (" + text[where:clause_end].strip() + ") " + text[clause_end:]
+    )
+
+
+def execute_chunked(connection, text, table, key, column=None,
+                    size=DEFAULT_CHUNK_ROWS, pause=0, label=None):
+    """Execute a statement in ranges of a key, committing after each.
+
+    The range of the key is read from table and the statement is run
+    once for every size keys, restricted with column BETWEEN low AND
+    high. This keeps each transaction small on huge tables.
+
+    Args:
+        connection: An open MySQLdb connection.
+        text (string): The statement to execute.
+        table (string): The table whose key range is covered.
+        key (string): The key column of table.
+        column (string): The column the statement is restricted on.
+            Defaults to key.
+        size (integer): Keys per chunk.
+        pause (float): Seconds to wait between chunks to let other
+            work through.
+        label (string): Name for the progress reports.
+
+    Returns:
+        tuple: (rows affected, warnings, first warning message)
+
+    Raises:
+        ValueError: If the statement can't be restricted to a range.
+        MySQLdb.Error: If a chunk failed. Earlier chunks stay committed.
+    """
+    head, tail = split_for_range(text, column or key)
+    size = int(size)
+    rowcount = 0
+    warnings = 0
+    warning = None
+    cur = connection.cursor()
+    try:
+        cur.execute("SELECT MIN({0}), MAX({0}) FROM {1}".format(key, table))
+        low, high = cur.fetchone()
+        if low is None:
+            return (rowcount, warnings, warning)
+        low, high = int(low), int(high)
+        progress = ProgressMeter(
+            label or "Chunks of " + table,
+            high - low + 1,
+            units="keys"
+        )
+        start = low
+        while start <= high:
+            end = min(start + size - 1, high)
+            try:
+                cur.execute(
+                    "{}{} BETWEEN {:d} AND {:d}{}".format(
+                        head, column or key, start, end, tail
+                    )
+                )
+            except mdb.Warning as warn:
+                warnings += connection.warning_count() or 1
+                if warning is None:
+                    warning = str(warn)
+                    logger.warning("Warning in keys %s-%s: %s", start, end, warn)
+            else:
+                warnings += connection.warning_count()
+            rowcount += max(cur.rowcount, 0)
+            connection.commit()
+            progress.update(end - low + 1)
+            start = end + 1
+            if pause and start <= high:
+                time.sleep(float(pause))
+    finally:
+        cur.close()
+    return (rowcount, warnings, warning)
+
+
+def is_session_statement(text):
+    """Check if a statement changes the state of the session."""
+    return bool(_SESSION_STATEMENT.match(text))
+
+
+def _track_temporary(statement, temporary):
+    """Follow the temporary tables that skipped statements create and drop."""
+    match = _CREATE_TEMPORARY.match(statement.text)
+    if match:
+        temporary[match.group(1).split(".")[-1].strip("`").lower()] = (
+            statement.index)
+        return
+    match = _DROP_TABLES.match(statement.text)
+    if match:
+        for name in match.group(1).split(","):
+            temporary.pop(name.split(".")[-1].strip().strip("`").lower(), None)
+
+
+def execute_statements(connection, statements, filename=None,
+                       journal=None, from_statement=None, clear=True,
+                       commit_every=None, profile=False):
+    """Execute statements on an open connection.
+
+    Statements run with autocommit enabled, like the mysql client,
+    unless commit_every is set. Execution stops at the first error.
+    Server warnings are logged and counted but don't stop the script.
+
+    With a journal, statements that completed in an earlier run are
+    skipped and each completed statement is recorded. The journal is
+    cleared once the whole script has run. Skipped SET and USE
+    statements are still executed to restore the session state. A
+    temporary table can't be restored that way, so the script won't
+    resume past one that a skipped statement created.
+
+    Args:
+        connection: An open MySQLdb connection.
+        statements: An iterable of Statement objects.
+        filename (string): The script the statements came from.
+        journal (ScriptJournal): Progress journal for resuming the script.
+        from_statement (integer): Skip the statements before this one.
+        clear (boolean): Clear the journal if every statement completed.
+        commit_every (integer): Commit after this many statements
+            instead of after each one. The journal entries are committed
+            with the statements, and an error rolls back the open batch.
+            The batch is also committed after statements that can't be
+            rolled back. See CommitPoints.
+        profile (boolean): Keep the result of every statement.
+
+    Returns:
+        ScriptResult: Rows affected and timings.
+    """
+    result = ScriptResult(filename, profile)
+    batch = StatementBatch(connection, commit_every, journal)
+    # Temporary tables created by skipped statements, by name
+    temporary = {}
+    batch.start()
+    try:
+        if journal:
+            if from_statement:
+                journal.clear()
+            completed = journal.load()
+            if completed:
+                logger.info(
+                    "Resuming %s: %s statements already completed",
+                    filename,
+                    len(completed)
+                )
+        for statement in statements:
+            if (from_statement and statement.index < from_statement) or (
+                    journal and journal.is_completed(statement)):
+                if not is_session_statement(statement.text):
+                    result.skipped += 1
+                    _track_temporary(statement, temporary)
+                    continue
+            try:
+                if temporary:
+                    raise ValueError(
+                        "Can't resume at statement {} because statement {} "
+                        "created the temporary table {} in an earlier "
+                        "session. Run the script from the beginning.".format(
+                            statement.index,
+                            min(temporary.values()),
+                            ", ".join(sorted(temporary))
+                        )
+                    )
+                statement_result = execute_statement(connection, statement)
+            except (mdb.Error, ValueError) as ex:
+                logger.error(
+                    "Error at statement %s, lines %s-%s: %s\n\t%s",
+                    statement.index,
+                    statement.first_line,
+                    statement.last_line,
+                    ex,
+                    statement.summary()
+                )
+                result.error = ex
+                result.failed_statement = statement
+                batch.rollback()
+                break
+            result.add(statement_result)
+            batch.completed(statement)
+        batch.commit()
+        if journal and clear and result.success:
+            journal.clear()
+    except:
+        # e.g. the script file can't be read any further
+        batch.rollback()
+        raise
+    finally:
+        batch.stop()
+    return result
+
+
+def execute_file(connection, sql_file, chunk_size=DEFAULT_CHUNK_SIZE,
+                 use_mmap=False, journal=None, from_statement=None,
+                 commit_every=None, profile=False):
+    """Execute a script file on an open connection.
+
+    The file is streamed so memory use is bounded by the size of the
+    largest statement rather than the size of the file.
+
+    Args:
+        connection: An open MySQLdb connection.
+        sql_file (string): Path to the script file, optionally
+            compressed with gzip (.gz) or xz (.xz).
+        chunk_size (integer): Bytes to read from the file at a time.
+        use_mmap (boolean): Read uncompressed files through a memory map.
+        journal (ScriptJournal): Progress journal for resuming the script.
+        from_statement (integer): Skip the statements before this one.
+        commit_every (integer): Commit after this many statements.
+        profile (boolean): Keep the result of every statement.
+
+    Returns:
+        ScriptResult: Rows affected and timings.
+    """
+    progress = ProgressMeter(
+        os.path.basename(sql_file),
+        os.path.getsize(sql_file)
+    )
+    with ScriptReader(sql_file, chunk_size, use_mmap, progress) as script:
+        result = execute_statements(
+            connection,
+            split_statements(script),
+            sql_file,
+            journal,
+            from_statement,
+            commit_every=commit_every,
+            profile=profile
+        )
+    if progress.done and progress.rate():
+        logger.debug(
+            "Read %s of %s at %s/s",
+            format_bytes(progress.done),
+            sql_file,
+            format_bytes(progress.rate())
+        )
+    return result
@@ -0,0 +1,516 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Run independent stages of a migration script in parallel.
+
+A script is divided into stages with directive comments:
+
+    -- @stage posts
+    REPLACE INTO acc_wp_posts ... SELECT ... FROM node ...;
+
+Each stage runs until the next @stage directive. The tables a stage
+reads and writes are inferred from its statements and can be extended
+with reads=, writes= and after= options, e.g.
+
+    -- @stage comments writes=acc_wp_comments after=posts
+
+A stage waits for every earlier stage whose tables conflict with its
+own, so stages touching disjoint tables run at the same time on
+separate connections. Statements before the first @stage directive are
+run first on their own, and any SET or USE statements among them are
+repeated on every connection. They are executed as they are read, but
+the statements of the stages are held in memory so they can be
+scheduled.
+"""
+
+import re
+import time
+import itertools
+import logging
+import threading
+import Queue
+import MySQLdb as mdb
+import sql_script
+
+logger = logging.getLogger(__name__)
+
+# Tokens of a statement once strings and comments are removed
+_TOKEN = re.compile(r"`[^`]*`(?:\.`[^`]*`)?|\w+(?:\.\w+)?|[(),]")
+_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"")
+_COMMENT = re.compile(r"/\*.*?\*/", re.DOTALL)
+# Keywords followed by one or more table names
+_TABLE_KEYWORDS = set([
+    'FROM', 'JOIN', 'INTO', 'UPDATE', 'TABLE', 'TABLES', 'LIKE', 'TRUNCATE'
+])
+# Options written between a verb and its tables
+_MODIFIERS = set([
+    'LOW_PRIORITY', 'HIGH_PRIORITY', 'DELAYED', 'QUICK', 'IGNORE'
+])
+# Words that can't be a table alias
+_RESERVED = set([
+    'ON', 'USING', 'WHERE', 'SET', 'INNER', 'LEFT', 'RIGHT', 'OUTER',
+    'CROSS', 'STRAIGHT_JOIN', 'NATURAL', 'JOIN', 'GROUP', 'ORDER', 'LIMIT',
+    'HAVING', 'VALUES', 'VALUE', 'SELECT', 'UNION', 'AS', 'TO', 'WHEN',
+    'THEN', 'ELSE', 'END', 'AND', 'OR', 'FOR', 'LOCK', 'IN', 'READ',
+    'WRITE', 'LOW_PRIORITY', 'IGNORE', 'IF', 'EXISTS', 'NOT', 'TABLE',
+    'PARTITION', 'FORCE', 'USE', 'DUPLICATE', 'KEY', 'INDEX', 'WITH',
+    'ENGINE', 'DEFAULT', 'CHARSET', 'COLLATE', 'PRIMARY', 'UNIQUE', 'LIKE',
+])
+# Statements that only touch the tables they name
+_DATA_VERBS = set([
+    'SELECT', 'INSERT', 'REPLACE', 'UPDATE', 'DELETE', 'TRUNCATE',
+    'CREATE', 'DROP', 'ALTER', 'RENAME'
+])
+
+
+class Stage(object):
+    """A group of statements that runs on a single connection.
+
+    Attributes:
+        name (string): The stage name.
+        statements (list): The Statement objects of the stage.
+        reads (set): Tables the stage reads.
+        writes (set): Tables the stage writes.
+        after (set): Names of stages this stage must follow.
+        barrier (boolean): True if the stage must run on its own, e.g.
+            because a statement couldn't be analysed.
+        depends (set): Earlier stages this stage waits for.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.statements = []
+        self.reads = set()
+        self.writes = set()
+        self.after = set()
+        self.barrier = False
+        self.depends = set()
+
+    def add(self, statement):
+        self.statements.append(statement)
+        tables = statement_tables(statement.text)
+        if tables is None:
+            self.barrier = True
+        else:
+            reads, writes = tables
+            self.reads.update(reads)
+            self.writes.update(writes)
+
+    def conflicts_with(self, other):
+        """Check if two stages must run one after the other."""
+        return bool(
+            self.writes & (other.reads | other.writes) or
+            other.writes & self.reads
+        )
+
+
+def _table_name(token):
+    """Get the table name from a possibly quoted or qualified token."""
+    return token.split(".")[-1].strip("`").lower()
+
+
+def _is_name(token):
+    return token not in ("(", ")", ",") and not token.isdigit()
+
+
+def statement_tables(text):
+    """Infer the tables a statement reads and writes.
+
+    The inference is conservative: it may report tables a statement
+    doesn't use, which only reduces parallelism. A statement that
+    changes data but whose written tables can't be found is treated
+    as having effects beyond the tables it names.
+
+    Args:
+        text (string): The statement.
+
+    Returns:
+        tuple: (reads, writes) sets of table names, or None if the
+            statement may have effects beyond the tables it names.
+    """
+    text = _STRING.sub("''", _COMMENT.sub(" ", text))
+    tokens = _TOKEN.findall(text)
+    if not tokens:
+        return set(), set()
+    verb = tokens[0].upper()
+    if verb not in _DATA_VERBS or re.search(r"\bTEMPORARY\b", text, re.I):
+        # Temporary tables only exist on the connection that made them
+        return None
+
+    referenced = []
+    update_targets = []
+    i = 0
+    while i < len(tokens):
+        word = tokens[i].upper()
+        keyword = word in _TABLE_KEYWORDS or (verb == 'RENAME' and word == 'TO')
+        i += 1
+        if not keyword:
+            continue
+        if word == 'TRUNCATE' and i < len(tokens) and tokens[i].upper() == 'TABLE':
+            i += 1
+        # Skip modifiers and IF [NOT] EXISTS
+        while i < len(tokens) and (
+                tokens[i].upper() in _MODIFIERS or
+                tokens[i].upper() in ('IF', 'NOT', 'EXISTS')):
+            i += 1
+        # A list of tables, each with an optional alias
+        while i < len(tokens) and _is_name(tokens[i]) \
+                and tokens[i].upper() not in _RESERVED:
+            referenced.append(_table_name(tokens[i]))
+            if word == 'UPDATE':
+                update_targets.append(referenced[-1])
+            i += 1
+            if i < len(tokens) and tokens[i].upper() == 'AS':
+                i += 1
+            if i < len(tokens) and _is_name(tokens[i]) \
+                    and tokens[i].upper() not in _RESERVED:
+                i += 1
+            if i < len(tokens) and tokens[i] == ",":
+                i += 1
+            else:
+                break
+
+    referenced_set = set(referenced)
+    if verb == 'SELECT':
+        return referenced_set, set()
+    if verb in ('INSERT', 'REPLACE', 'CREATE'):
+        writes = set(referenced[:1])
+    elif verb == 'UPDATE':
+        if re.search(r"\bJOIN\b", text, re.I):
+            # Any table joined in a multi-table update may be written
+            writes = referenced_set
+        else:
+            writes = set(update_targets)
+    else:
+        writes = referenced_set
+    if not writes:
+        return None
+    return referenced_set - writes, writes
+
+
+def group_stages(statements):
+    """Divide the statements of a script into stages.
+
+    Args:
+        statements: An iterable of Statement objects.
+
+    Returns:
+        tuple: (setup, stages) where setup is the list of statements
+            before the first @stage directive and stages is a list of
+            Stage objects with their dependencies resolved.
+    """
+    setup = []
+    stages = []
+    current = None
+    for statement in statements:
+        directive = statement.get_directive("stage")
+        if directive:
+            name = directive.args[0] if directive.args else (
+                "stage_{}".format(len(stages) + 1))
+            current = Stage(name)
+            current.reads.update(
+                table.lower() for table in directive.get_list("reads"))
+            current.writes.update(
+                table.lower() for table in directive.get_list("writes"))
+            current.after.update(directive.get_list("after"))
+            stages.append(current)
+        if current is None:
+            setup.append(statement)
+        else:
+            current.add(statement)
+
+    for position, stage in enumerate(stages):
+        for earlier in stages[:position]:
+            if (stage.barrier or earlier.barrier or
+                    earlier.name in stage.after or
+                    stage.conflicts_with(earlier)):
+                stage.depends.add(earlier)
+    return setup, stages
+
+
+class StagedScript(object):
+    """Split a script into the statements before its stages and the stages.
+
+    Iterating yields the statements before the first @stage directive as
+    they are read, for the caller to execute. The rest of the script is
+    then read into Stage objects. If the stages can't run in parallel,
+    their statements are yielded as well, in script order.
+
+    Attributes:
+        name (string): The script name, for logging.
+        session (list): The SET and USE statements before the stages.
+        stages (list): Stage objects, once the setup statements are read.
+        serial_reason (string): Why the stages must run serially, or None.
+    """
+
+    def __init__(self, statements, name=None):
+        self._statements = iter(statements)
+        self._temporary = False
+        self.name = name
+        self.session = []
+        self.stages = []
+        self.serial_reason = None
+
+    @property
+    def parallel(self):
+        """True if the stages are left for execute_stages() to run."""
+        return bool(self.stages) and self.serial_reason is None
+
+    def __iter__(self):
+        for statement in self._statements:
+            if statement.get_directive("stage"):
+                break
+            if sql_script.is_session_statement(statement.text):
+                self.session.append(statement)
+            if re.search(r"\bTEMPORARY\b", statement.text, re.I):
+                self._temporary = True
+            yield statement
+        else:
+            return
+
+        self.stages = group_stages(
+            itertools.chain([statement], self._statements))[1]
+        self.serial_reason = self._get_serial_reason()
+        if self.serial_reason:
+            logger.info("Running %s serially because %s",
+                        self.name, self.serial_reason)
+            for stage in self.stages:
+                for statement in stage.statements:
+                    yield statement
+
+    def _get_serial_reason(self):
+        stage_statements = [
+            statement for stage in self.stages
+            for statement in stage.statements
+        ]
+        if len(self.stages) < 2:
+            return "it has fewer than two stages"
+        if self._temporary or any(
+                re.search(r"\bTEMPORARY\b", statement.text, re.I)
+                for statement in stage_statements):
+            return "it uses temporary tables"
+        if any(sql_script.is_session_statement(statement.text)
+               for statement in stage_statements):
+            return "it changes the session inside a stage"
+        return None
+
+
+def _run_stage(stage, connection, journal, skip, profile, commit_every,
+               results):
+    """Run the statements of a stage and report back on a queue."""
+    stage_result = sql_script.ScriptResult(stage.name, profile)
+    batch = sql_script.StatementBatch(connection, commit_every, journal)
+    try:
+        batch.start()
+        for statement in stage.statements:
+            if statement.index in skip:
+                continue
+            stage_result.failed_statement = statement
+            stage_result.add(
+                sql_script.execute_statement(connection, statement)
+            )
+            batch.completed(statement)
+        stage_result.failed_statement = None
+        batch.commit()
+    except Exception as ex:
+        # Report any failure so the scheduler doesn't wait forever
+        stage_result.error = ex
+        if stage_result.failed_statement is None:
+            stage_result.failed_statement = stage.statements[-1]
+        try:
+            batch.rollback()
+        except Exception as rollback_error:
+            logger.debug("Could not roll back stage %s: %s",
+                         stage.name, rollback_error)
+    finally:
+        try:
+            batch.stop(True)
+        except Exception as autocommit_error:
+            logger.debug("Could not restore autocommit after stage %s: %s",
+                         stage.name, autocommit_error)
+        results.put((stage, connection, stage_result))
+
+
+def execute_stages(connection, connect, stages, workers, result,
+                   session=(), journal=None, from_statement=None,
+                   commit_every=None):
+    """Run the stages of a script with up to workers connections.
+
+    Args:
+        connection: An open MySQLdb connection, used as one of the
+            workers.
+        connect: A function that borrows another connection. It returns
+            the connection and a function that hands it back, which
+            takes False if the connection mustn't be reused.
+        stages (list): Stage objects from group_stages().
+        workers (integer): Maximum number of stages to run at once.
+        result (ScriptResult): The result of the statements before the
+            stages, which the stages are added to.
+        session (list): SET and USE statements to repeat on every other
+            connection.
+        journal (ScriptJournal): Progress journal for resuming the
+            script, already loaded.
+        from_statement (integer): Skip the statements before this one.
+        commit_every (integer): Commit each stage in batches of this many
+            statements. See sql_script.StatementBatch.
+
+    Returns:
+        ScriptResult: result, with the rows affected and timings of the
+            stages added.
+    """
+    start = time.time()
+    profile = result.statements is not None
+    connection.autocommit(True)
+    skip = set(
+        statement.index
+        for stage in stages
+        for statement in stage.statements
+        if (from_statement and statement.index < from_statement) or (
+            journal and journal.is_completed(statement))
+    )
+
+    idle = [(connection, journal)]
+    releases = []
+    results = Queue.Queue()
+    pending = list(stages)
+    running = 0
+    done = set()
+    try:
+        for number in range(min(workers, len(stages)) - 1):
+            try:
+                worker_connection, release = connect()
+            except mdb.OperationalError as ex:
+                logger.warning(
+                    "Running the stages on %s connections: %s",
+                    len(idle),
+                    ex
+                )
+                break
+            releases.append(release)
+            worker_connection.autocommit(True)
+            for statement in session:
+                sql_script.execute_statement(worker_connection, statement)
+            idle.append((
+                worker_connection,
+                journal.for_connection(worker_connection) if journal else None
+            ))
+
+        while pending or running:
+            if result.success:
+                for stage in list(pending):
+                    if not idle:
+                        break
+                    if stage.depends <= done:
+                        worker_connection, worker_journal = idle.pop()
+                        pending.remove(stage)
+                        running += 1
+                        logger.debug("Starting stage %s", stage.name)
+                        thread = threading.Thread(
+                            target=_run_stage,
+                            args=(stage, worker_connection, worker_journal,
+                                  skip, profile, commit_every, results)
+                        )
+                        thread.daemon = True
+                        thread.start()
+            if not running:
+                break
+            stage, worker_connection, stage_result = results.get()
+            running -= 1
+            idle.append((
+                worker_connection,
+                journal.for_connection(worker_connection) if journal else None
+            ))
+            result.merge(stage_result)
+            error = stage_result.error
+            failed = stage_result.failed_statement
+            if error is None:
+                done.add(stage)
+                logger.debug("Finished stage %s", stage.name)
+            elif result.success:
+                logger.error(
+                    "Error in stage %s at statement %s, lines %s-%s: %s\n\t%s",
+                    stage.name,
+                    failed.index,
+                    failed.first_line,
+                    failed.last_line,
+                    error,
+                    failed.summary()
+                )
+                result.error = error
+                result.failed_statement = failed
+    finally:
+        for release in releases:
+            try:
+                # The replayed SET and USE statements stay with the session
+                release(not session)
+            except mdb.Error as ex:
+                logger.warning("Could not release a stage connection: %s", ex)
+        connection.autocommit(False)
+
+    result.skipped += len(skip)
+    if result.statements:
+        result.statements.sort(key=lambda item: item.index)
+    if journal and result.success:
+        journal.clear()
+    logger.debug(
+        "Ran %s stages in %.2fs with up to %s connections",
+        len(done),
+        time.time() - start,
+        len(releases) + 1
+    )
+    return result
+
+
+def execute_file(connection, connect, sql_file, workers,
+                 journal=None, from_statement=None, profile=False,
+                 chunk_size=sql_script.DEFAULT_CHUNK_SIZE, use_mmap=False,
+                 commit_every=None):
+    """Execute a script, running independent stages in parallel.
+
+    Scripts without @stage directives, or that use temporary tables or
+    change the session inside a stage, run serially. The statements
+    before the first @stage directive, and those of a serial script, are
+    streamed from the file, but the statements of parallel stages are
+    all held in memory.
+
+    Args:
+        connection: An open MySQLdb connection.
+        connect: A function that borrows another connection. See
+            execute_stages().
+        sql_file (string): Path to the script file.
+        workers (integer): Maximum number of stages to run at once.
+        journal (ScriptJournal): Progress journal for resuming the script.
+        from_statement (integer): Skip the statements before this one.
+        profile (boolean): Keep the result of every statement.
+        chunk_size (integer): Bytes to read from the file at a time.
+        use_mmap (boolean): Read uncompressed files through a memory map.
+        commit_every (integer): Commit after this many statements.
+
+    Returns:
+        ScriptResult: Rows affected and timings.
+    """
+    with sql_script.ScriptReader(sql_file, chunk_size, use_mmap) as script:
+        staged = StagedScript(sql_script.split_statements(script), sql_file)
+        # The journal is cleared once the stages have run too
+        result = sql_script.execute_statements(
+            connection, staged, sql_file, journal, from_statement,
+            clear=False, commit_every=commit_every, profile=profile
+        )
+    if not result or not staged.parallel:
+        if journal and result.success:
+            journal.clear()
+        return result
+
+    logger.info(
+        "Running %s stages of %s with up to %s connections",
+        len(staged.stages),
+        sql_file,
+        workers
+    )
+    logger.debug(
+        "Holding the %s statements of the stages in memory",
+        sum(len(stage.statements) for stage in staged.stages)
+    )
+    return execute_stages(
+        connection, connect, staged.stages, workers, result, staged.session,
+        journal, from_statement, commit_every
+    )
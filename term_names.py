@@ -0,0 +1,89 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Make Drupal term names unique and short enough for WordPress.
+
+WordPress term names are limited to 200 characters and the migration
+needs them to be unique. Both limits are resolved together in a single
+pass over the terms, so truncating a name can't create a new duplicate.
+"""
+
+import unicodedata
+
+# WordPress' wp_terms.name column length
+MAX_TERM_NAME_LENGTH = 200
+
+
+def collation_key(name):
+    """Reduce a name to the form MySQL compares it in.
+
+    This approximates the utf8_general_ci collation of Drupal tables:
+    case and accents are ignored, and so are trailing spaces. Some
+    characters still compare differently, e.g. the server treats ß as
+    s, so the server should have the last word on duplicates.
+
+    Args:
+        name (string): A term name.
+
+    Returns:
+        unicode: The comparison key.
+    """
+    if not isinstance(name, unicode):
+        name = name.decode('utf8')
+    decomposed = unicodedata.normalize('NFKD', name)
+    key = u"".join(c for c in decomposed if not unicodedata.combining(c))
+    return key.lower().rstrip(u" ")
+
+
+def suffixed_name(name, tid, count=1, max_length=MAX_TERM_NAME_LENGTH):
+    """Append the term id to a name, truncating it so the suffix fits.
+
+    Args:
+        name (string): A term name.
+        tid (integer): The term id.
+        count (integer): Appended after the term id when greater than 1,
+            in case the suffixed name is taken too.
+        max_length (integer): The maximum length of a name.
+
+    Returns:
+        unicode: The suffixed name.
+    """
+    if count > 1:
+        suffix = u"_{}_{}".format(tid, count)
+    else:
+        suffix = u"_{}".format(tid)
+    return name[:max_length - len(suffix)].rstrip(u" ") + suffix
+
+
+def uniquify(terms, max_length=MAX_TERM_NAME_LENGTH):
+    """Find the terms that must be renamed.
+
+    Terms should be ordered by tid so the lowest tid keeps its name.
+    Names that are too long are truncated, and a name that is already
+    taken has its term id appended, after truncating it so that the
+    suffix still fits.
+
+    Args:
+        terms (iterable): Dictionaries with the tid and name of each term.
+        max_length (integer): The maximum length of a name.
+
+    Returns:
+        list: Dictionaries with the tid and new name of each term that
+            must be renamed.
+    """
+    taken = set()
+    renamed = []
+    for term in terms:
+        tid = term["tid"]
+        name = term["name"] or u""
+        candidate = name[:max_length]
+        key = collation_key(candidate)
+        count = 0
+        # The suffixed name may itself be another term's name
+        while key in taken:
+            count += 1
+            candidate = suffixed_name(name, tid, count, max_length)
+            key = collation_key(candidate)
+        taken.add(key)
+        if candidate != name:
+            renamed.append({'tid': tid, 'name': candidate})
+    return renamed